@@ -6,9 +6,10 @@ class UserAdmin(admin.ModelAdmin):
     list_display = ("username", "active_subscriptions", "email", "is_active")
 
     def active_subscriptions(self, obj):
-        return Subscription.objects.filter(user=obj).count()
+        return obj.subscriptions_count
 
     active_subscriptions.short_description = "Subscriptions"
+    active_subscriptions.admin_order_field = "subscriptions_count"
 
 
 admin.site.register(CustomUser, UserAdmin)
@@ -16,11 +17,13 @@ admin.site.register(CustomUser, UserAdmin)
 
 class UserSubscriptionAdmin(admin.ModelAdmin):
     list_display = ("user", "city_name", "period", "next_message")
+    list_select_related = ("user", "city")
 
     def city_name(self, obj):
         return obj.city.name
 
     city_name.short_description = "City"
+    city_name.admin_order_field = "city__name"
 
     def next_message(self, obj):
         return obj.next_message
@@ -34,6 +37,8 @@ admin.site.register(Subscription, UserSubscriptionAdmin)
 class WeatherDataAdmin(admin.ModelAdmin):
     list_display = ("city_name", "id", "updated_at", "active_users", "has_weather_data")
 
+    list_select_related = ("city",)
+
     def has_weather_data(self, obj):
         return bool(obj.weather_data)
 
@@ -41,14 +46,16 @@ class WeatherDataAdmin(admin.ModelAdmin):
     has_weather_data.short_description = "Weather Data"
 
     def active_users(self, obj):
-        return Subscription.objects.filter(city=obj.city).count()
+        return obj.city.subscribers_count
 
     active_users.short_description = "Active users"
+    active_users.admin_order_field = "city__subscribers_count"
 
     def city_name(self, obj):
         return obj.city.name
 
     city_name.short_description = "City"
+    city_name.admin_order_field = "city__name"
 
 
 admin.site.register(WeatherData, WeatherDataAdmin)
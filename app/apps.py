@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class WeatherReminderConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "app"
+
+    def ready(self):
+        from . import log, metrics, profiling, signals  # noqa: F401
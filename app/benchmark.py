@@ -0,0 +1,221 @@
+import json
+import platform
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+
+from celery import current_app
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import mail, providers
+from .fetcher import WeatherFetcher
+from .geo import grid_cell
+from .models import City, CustomUser, Subscription, WeatherData
+from .testing import LocalSMTPServer, LocalWeatherServer
+
+BASELINE_PATH = Path(__file__).resolve().parent / "data" / "benchmark_baseline.json"
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Measurement:
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        self.queries = []
+        self.items = 0
+
+    @contextmanager
+    def sample(self, items=1):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            yield
+            self.samples.append(time.perf_counter() - started)
+        self.queries.append(len(queries))
+        self.items += items
+
+    def summary(self):
+        return {
+            "runs": len(self.samples),
+            "items": self.items,
+            "throughput": round(self.items / sum(self.samples), 1),
+            "p50_ms": round(percentile(self.samples, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(self.samples, 0.99) * 1000, 2),
+            "queries": max(self.queries),
+        }
+
+
+def seed(users, cities, subscriptions_per_user):
+    now = timezone.now()
+    per_user = min(subscriptions_per_user, cities, 5)
+    subscribers = Counter((i + j) % cities for i in range(users) for j in range(per_user))
+    city_rows = []
+    for i in range(cities):
+        # Spread over the globe so cities don't collapse into one shared fetch
+        latitude, longitude = -60 + (i * 7.3) % 120, -180 + (i * 13.7) % 360
+        city_rows.append(
+            City(
+                name=f"Benchmark {i}",
+                latitude=latitude,
+                longitude=longitude,
+                cell=grid_cell(latitude, longitude, settings.WEATHER_SHARED_RADIUS_KM),
+                subscribers_count=subscribers[i],
+            )
+        )
+    city_rows = City.objects.bulk_create(city_rows)
+
+    user_rows = CustomUser.objects.bulk_create(
+        CustomUser(
+            username=f"benchmark{i}",
+            email=f"benchmark{i}@example.com",
+            password="!",
+            subscriptions_count=per_user,
+        )
+        for i in range(users)
+    )
+    subscriptions = [
+        Subscription(
+            id=uuid.uuid4(),
+            user=user,
+            city=city_rows[(i + j) % cities],
+            next_message=now,
+        )
+        for i, user in enumerate(user_rows)
+        for j in range(per_user)
+    ]
+    Subscription.objects.bulk_create(subscriptions, batch_size=1000)
+    return subscriptions
+
+
+@contextmanager
+def stand_ins():
+    # Local weather API, SMTP sink and cache, no rate limiting, Celery tasks inline
+    eager = current_app.conf.task_always_eager
+    with LocalWeatherServer() as weather_server, LocalSMTPServer() as smtp_server, override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        WEATHER_API_RATE_PER_SECOND=1e6,
+        WEATHER_API_BURST=10**6,
+        WEATHER_API_FAILURE_THRESHOLD=10**6,
+        EMAIL_HOST_USER="benchmark@example.com",
+    ):
+        current_app.conf.task_always_eager = True
+        providers._provider = providers.OpenWeatherMapProvider(
+            WeatherFetcher(base_url=weather_server.url, api_key="benchmark")
+        )
+        mail._pool = mail.SMTPConnectionPool(
+            backend="django.core.mail.backends.smtp.EmailBackend",
+            host="127.0.0.1",
+            port=smtp_server.port,
+            use_ssl=False,
+            use_tls=False,
+            username="",
+            password="",
+        )
+        try:
+            yield weather_server, smtp_server
+        finally:
+            current_app.conf.task_always_eager = eager
+            providers._provider.fetcher.close()
+            providers._provider = None
+            mail._pool.close()
+            mail._pool = None
+
+
+def bench_weather_refresh(repeat):
+    from .tasks import update_weather_data_async
+
+    measurement = Measurement("update_weather_data_async")
+    for _ in range(repeat):
+        WeatherData.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        with measurement.sample(items=City.objects.count()):
+            update_weather_data_async()
+    return measurement
+
+
+def bench_weather_email(repeat, smtp_server):
+    from .tasks import send_weather_email
+
+    measurement = Measurement("send_weather_email")
+    for _ in range(repeat):
+        Subscription.objects.update(next_message=timezone.now() - timedelta(minutes=1))
+        sent = len(smtp_server.messages)
+        with measurement.sample(items=0):
+            send_weather_email()
+        measurement.items += len(smtp_server.messages) - sent
+    return measurement
+
+
+def bench_weather_view(requests):
+    measurement = Measurement("get_weather_view")
+    client = Client()
+    subscription_ids = list(Subscription.objects.values_list("id", flat=True)[:requests])
+    for subscription_id in subscription_ids:
+        with measurement.sample():
+            response = client.get(reverse("get_weather", kwargs={"subscription_id": subscription_id}))
+        if response.status_code != 200:
+            raise RuntimeError(f"get_weather_view returned {response.status_code}")
+    return measurement
+
+
+def run(users=200, cities=50, subscriptions_per_user=3, repeat=3, requests=200):
+    with stand_ins() as (weather_server, smtp_server):
+        cache.clear()
+        seed(users, cities, subscriptions_per_user)
+        measurements = [
+            bench_weather_refresh(repeat),
+            bench_weather_email(repeat, smtp_server),
+            bench_weather_view(requests),
+        ]
+    return {measurement.name: measurement.summary() for measurement in measurements}
+
+
+def host():
+    return f"{platform.node()} {platform.machine()} Python {platform.python_version()}"
+
+
+def compare(results, baseline, tolerance=0.25, timings=False):
+    # Query counts are exact on any machine. Timings only mean something against
+    # a baseline from the same host, and may drift by `tolerance`
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result["queries"] > expected["queries"]:
+            regressions.append(f"{name}: {result['queries']} queries, baseline {expected['queries']}")
+        if not timings:
+            continue
+        if result["p50_ms"] > expected["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {result['p50_ms']}ms, baseline {expected['p50_ms']}ms")
+        if result["throughput"] < expected["throughput"] / (1 + tolerance):
+            regressions.append(
+                f"{name}: {result['throughput']} items/s, baseline {expected['throughput']} items/s"
+            )
+    return regressions
+
+
+def load_baseline(path=BASELINE_PATH):
+    # Returns (host, results); the host is None for a baseline without one
+    with open(path) as file:
+        baseline = json.load(file)
+    if "results" not in baseline:
+        return None, baseline
+    return baseline.get("host"), baseline["results"]
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    with open(path, "w") as file:
+        json.dump({"host": host(), "results": results}, file, indent=2, sort_keys=True)
+        file.write("\n")
@@ -0,0 +1,197 @@
+import csv
+import json
+import time
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
+
+from .geocoding import normalize_name
+from .models import City, CustomUser, Subscription
+from .page_cache import invalidate_main_page
+from .utils import chunked
+
+USER_FIELDS = ("username", "email", "password")
+FLAG_FIELDS = (
+    "is_active",
+    "temperature",
+    "precipitation",
+    "cloudiness",
+    "humidity",
+    "wind",
+    "wind_speed",
+    "pressure",
+    "feels_like",
+)
+FIELDS = USER_FIELDS + ("city", "period", "next_message") + FLAG_FIELDS
+MAX_SUBSCRIPTIONS = 5
+
+
+def read_rows(file, format):
+    if format == "csv":
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _flag(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.users = 0
+        self.subscriptions = 0
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    @property
+    def rows_per_second(self):
+        return self.rows / max(time.perf_counter() - self.started, 1e-9)
+
+
+class SubscriptionImporter:
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        # Distinct names only, so each city is looked up or geocoded once per import
+        self.cities = {}
+        self.report = ImportReport()
+
+    def city_for(self, name):
+        key = normalize_name(name)
+        if key not in self.cities:
+            city = City.for_name(name.strip())
+            if city.is_pending:
+                from .tasks import resolve_city
+
+                transaction.on_commit(lambda city_id=city.id: resolve_city.delay(city_id))
+            self.cities[key] = (city.id, city.status)
+        return self.cities[key]
+
+    def run(self, rows):
+        for batch in chunked(rows, self.batch_size):
+            with transaction.atomic():
+                self.import_batch(batch)
+            yield self.report
+
+    def import_batch(self, batch):
+        self.report.rows += len(batch)
+        users = self._users(batch)
+
+        existing = set(
+            Subscription.objects.filter(user_id__in=[user.id for user in users.values()]).values_list(
+                "user_id", "city_id"
+            )
+        )
+        subscriptions = []
+        for row in batch:
+            user = users.get(row.get("username"))
+            if user is None:
+                self.report.skipped += 1
+                continue
+            if not row.get("city"):
+                continue
+            city_id, status = self.city_for(row["city"])
+            if status == City.Status.NOT_FOUND or (user.id, city_id) in existing:
+                self.report.skipped += 1
+                continue
+            if user.subscriptions_count >= MAX_SUBSCRIPTIONS:
+                self.report.skipped += 1
+                continue
+            subscription = Subscription(
+                user_id=user.id,
+                city_id=city_id,
+                period=int(row.get("period") or 6),
+                **{field: _flag(row[field]) for field in FLAG_FIELDS if row.get(field) not in (None, "")},
+            )
+            if row.get("next_message"):
+                subscription.next_message = parse_datetime(row["next_message"])
+            subscription.reschedule()
+            subscriptions.append(subscription)
+            existing.add((user.id, city_id))
+            user.subscriptions_count += 1
+
+        # bulk_create skips the counter signals, so the counters move here
+        Subscription.objects.bulk_create(subscriptions)
+        self._add_counts(CustomUser, "subscriptions_count", Counter(s.user_id for s in subscriptions))
+        self._add_counts(City, "subscribers_count", Counter(s.city_id for s in subscriptions))
+        if subscriptions:
+            # Bumped once the batch commits, so cached tables show the new rows
+            invalidate_main_page(*{subscription.user_id for subscription in subscriptions})
+        self.report.subscriptions += len(subscriptions)
+
+    def _users(self, batch):
+        usernames = {row["username"] for row in batch if row.get("username")}
+        users = {user.username: user for user in CustomUser.objects.filter(username__in=usernames)}
+        new_users = []
+        for row in batch:
+            username = row.get("username")
+            if not username or username in users:
+                continue
+            user = CustomUser(username=username, email=row.get("email") or "")
+            if row.get("password"):
+                # Exported password hashes are loaded as they are
+                user.password = row["password"]
+            else:
+                user.set_unusable_password()
+            users[username] = user
+            new_users.append(user)
+        CustomUser.objects.bulk_create(new_users)
+        self.report.users += len(new_users)
+        return users
+
+    @staticmethod
+    def _add_counts(model, field, counts):
+        # One UPDATE per distinct increment rather than one per row
+        ids_by_delta = defaultdict(list)
+        for pk, delta in counts.items():
+            ids_by_delta[delta].append(pk)
+        for delta, ids in ids_by_delta.items():
+            model.objects.filter(id__in=ids).update(**{field: F(field) + delta})
+
+
+def export_rows(chunk_size=2000):
+    subscriptions = (
+        Subscription.objects.select_related("user", "city")
+        .order_by("user__username", "city__name")
+        .iterator(chunk_size=chunk_size)
+    )
+    for subscription in subscriptions:
+        row = {field: getattr(subscription.user, field) for field in USER_FIELDS}
+        row.update(
+            city=subscription.city.name,
+            period=subscription.period,
+            next_message=subscription.next_message.isoformat(),
+        )
+        row.update({field: getattr(subscription, field) for field in FLAG_FIELDS})
+        yield row
+
+    users = (
+        CustomUser.objects.filter(subscriptions__isnull=True)
+        .order_by("username")
+        .values(*USER_FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+    for user in users:
+        yield {**dict.fromkeys(FIELDS, ""), **user}
+
+
+def write_rows(rows, file, format):
+    count = 0
+    if format == "csv":
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            file.write(json.dumps(row) + "\n")
+            count += 1
+    return count
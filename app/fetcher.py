@@ -0,0 +1,80 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .metrics import API_LATENCY, API_REJECTED
+from .ratelimit import ApiGuard
+from .utils import key
+
+
+class WeatherFetcher:
+    def __init__(self, base_url=None, api_key=None, concurrency=None, timeout=None, guard=None):
+        self.base_url = base_url or settings.WEATHER_API_URL
+        self.api_key = api_key if api_key is not None else key
+        self.concurrency = concurrency or settings.WEATHER_API_CONCURRENCY
+        self.timeout = timeout or settings.WEATHER_API_TIMEOUT
+        # Shared by every worker using this key, however many threads each runs
+        self.guard = guard or ApiGuard("openweathermap", self.api_key)
+
+        # requests.Session isn't documented as thread-safe, so each thread keeps
+        # its own, with one keep-alive connection reused across runs
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def fetch(self, latitude, longitude, rate_wait=None):
+        reason = self.guard.admit(wait=rate_wait)
+        if reason is not None:
+            API_REJECTED.labels("openweathermap").inc()
+            return {"error": reason}
+
+        params = {"lat": latitude, "lon": longitude, "appid": self.api_key, "units": "metric"}
+        started = time.perf_counter()
+        try:
+            response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            API_LATENCY.labels("openweathermap", "error").observe(time.perf_counter() - started)
+            self.guard.record(success=False)
+            return {"error": f"Error fetching weather data: {e}"}
+
+        API_LATENCY.labels("openweathermap", "success").observe(time.perf_counter() - started)
+        self.guard.record(success=True)
+        if isinstance(data, dict):
+            return data
+        return {"error": f"Unexpected weather data: {data!r}"}
+
+    def fetch_many(self, locations, rate_wait=None):
+        # Blocking requests on a thread pool; max_workers bounds the concurrency
+        if not locations:
+            return {}
+        results = self.executor.map(
+            lambda location: self.fetch(*location, rate_wait), locations.values()
+        )
+        return dict(zip(locations, results))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self._sessions_lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
@@ -57,12 +57,21 @@ class CreateSubscriptionForm(forms.ModelForm):
             "wind_speed": forms.CheckboxInput(),
         }
 
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+
     def clean_city(self):
+        # Before the lookup, which may already save a pending city
+        if self.user is not None:
+            self.user.check_subscriptions_amount()
         city_name = self.cleaned_data["city"]
-        city, created = City.objects.get_or_create(name=city_name)
-        if created:
-            city.set_coordinates()
-            city.save()
+        city = City.for_name(city_name)
+        if city.status == City.Status.NOT_FOUND:
+            raise forms.ValidationError(f"City {city_name} not found")
+        # Other spellings resolve to the same city, which the user may already follow
+        if self.user is not None and Subscription.objects.filter(user=self.user, city=city).exists():
+            raise forms.ValidationError(f"You are already subscribed to {city}")
         return city
 
 
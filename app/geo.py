@@ -0,0 +1,128 @@
+import math
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(longitude2 - longitude1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _columns(row, size):
+    # Number of columns in `row`. Each spans at least `size` degrees of arc at
+    # any latitude up to one row poleward of `row`, so columns are never
+    # narrower than radius_km for points in this row or the rows next to it.
+    # A whole number of them divides the full circle, so they wrap at ±180
+    edge = max(abs(row), abs(row + 1)) * size + size
+    if edge >= 90:
+        return 1
+    return max(1, math.floor(360 * math.cos(math.radians(edge)) / size))
+
+
+def _column(longitude, columns):
+    return math.floor((longitude + 180) % 360 / (360 / columns)) % columns
+
+
+def grid_cell(latitude, longitude, radius_km):
+    # Rows are radius_km tall and columns at least radius_km wide, so every
+    # point within radius_km lies in the same cell or one of the cells listed
+    # by neighbor_cells
+    size = radius_km / KM_PER_DEGREE
+    row = math.floor(latitude / size)
+    return f"{row}:{_column(longitude, _columns(row, size))}"
+
+
+def neighbor_cells(latitude, longitude, radius_km):
+    # Column counts differ between rows, so the columns are found per row
+    size = radius_km / KM_PER_DEGREE
+    cells = []
+    for row in range(math.floor(latitude / size) - 1, math.floor(latitude / size) + 2):
+        columns = _columns(row, size)
+        column = _column(longitude, columns)
+        for j in (-1, 0, 1):
+            cell = f"{row}:{(column + j) % columns}"
+            if cell not in cells:
+                cells.append(cell)
+    return cells
+
+
+def _to_cartesian(latitude, longitude):
+    phi, lam = math.radians(latitude), math.radians(longitude)
+    return (math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi))
+
+
+def _chord(radius_km):
+    # Straight-line distance on the unit sphere matching a great-circle distance
+    return 2 * math.sin(min(radius_km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+class KDTree:
+    def __init__(self, points):
+        # points: list of (latitude, longitude, item)
+        self.nodes = [(_to_cartesian(latitude, longitude), item) for latitude, longitude, item in points]
+        self.root = self._build(list(range(len(self.nodes))), 0)
+
+    def _build(self, indexes, depth):
+        if not indexes:
+            return None
+        axis = depth % 3
+        indexes.sort(key=lambda i: self.nodes[i][0][axis])
+        middle = len(indexes) // 2
+        return (
+            indexes[middle],
+            axis,
+            self._build(indexes[:middle], depth + 1),
+            self._build(indexes[middle + 1 :], depth + 1),
+        )
+
+    def query_radius(self, latitude, longitude, radius_km):
+        target = _to_cartesian(latitude, longitude)
+        limit = _chord(radius_km)
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            index, axis, left, right = node
+            point, item = self.nodes[index]
+            if math.dist(point, target) <= limit:
+                found.append(item)
+            delta = target[axis] - point[axis]
+            stack.append(left if delta <= 0 else right)
+            if abs(delta) <= limit:
+                stack.append(right if delta <= 0 else left)
+        return found
+
+
+class CityIndex:
+    def __init__(self, cities):
+        self.cities = [city for city in cities if city.latitude is not None and city.longitude is not None]
+        self.tree = KDTree([(city.latitude, city.longitude, city) for city in self.cities])
+
+    def within(self, latitude, longitude, radius_km):
+        return self.tree.query_radius(latitude, longitude, radius_km)
+
+    def clusters(self, radius_km):
+        # Greedily assigns every city to the first earlier city within radius_km;
+        # returns {representative: [cities sharing its weather]}
+        assigned = set()
+        clusters = {}
+        for city in sorted(self.cities, key=lambda city: city.pk):
+            if city.pk in assigned:
+                continue
+            members = sorted(
+                (
+                    member
+                    for member in self.within(city.latitude, city.longitude, radius_km)
+                    if member.pk not in assigned
+                ),
+                key=lambda member: member.pk,
+            )
+            assigned.update(member.pk for member in members)
+            clusters[city] = members
+        return clusters
@@ -0,0 +1,90 @@
+import bisect
+import csv
+import re
+import unicodedata
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from geopy.geocoders import Nominatim
+
+GAZETTEER_PATH = Path(__file__).resolve().parent / "data" / "gazetteer.csv"
+
+
+def normalize_name(name):
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    name = re.sub(r"[^\w\s]", " ", name.casefold())
+    return " ".join(name.split())
+
+
+class Gazetteer:
+    def __init__(self, path=GAZETTEER_PATH):
+        with open(path, newline="", encoding="utf-8") as file:
+            rows = sorted(
+                (normalize_name(row["name"]), float(row["latitude"]), float(row["longitude"]))
+                for row in csv.DictReader(file)
+            )
+        self.names = [name for name, _, _ in rows]
+        self.coordinates = [(latitude, longitude) for _, latitude, longitude in rows]
+
+    def lookup(self, name):
+        index = bisect.bisect_left(self.names, name)
+        if index < len(self.names) and self.names[index] == name:
+            return self.coordinates[index]
+        return None
+
+
+_gazetteer = None
+
+
+def get_gazetteer():
+    global _gazetteer
+    if _gazetteer is None:
+        _gazetteer = Gazetteer()
+    return _gazetteer
+
+
+def _cache_key(name):
+    return f"geocode:{name}"
+
+
+def geocode_offline(name):
+    # Cache, bundled gazetteer and the database; never touches the network
+    from .models import GeocodedName
+
+    name = normalize_name(name)
+    coordinates = cache.get(_cache_key(name))
+    if coordinates is not None:
+        return tuple(coordinates)
+
+    coordinates = get_gazetteer().lookup(name)
+    if coordinates is None:
+        coordinates = (
+            GeocodedName.objects.filter(name=name).values_list("latitude", "longitude").first()
+        )
+    if coordinates is not None:
+        cache.set(_cache_key(name), coordinates, settings.GEOCODING_CACHE_TIMEOUT)
+    return coordinates
+
+
+def geocode(name):
+    from .models import GeocodedName
+
+    coordinates = geocode_offline(name)
+    if coordinates is not None:
+        return coordinates
+
+    location = Nominatim(user_agent=settings.NOMINATUM_ACCOUNT_NAME).geocode(
+        name, timeout=settings.GEOCODING_TIMEOUT
+    )
+    if location is None:
+        return None
+
+    coordinates = (location.latitude, location.longitude)
+    GeocodedName.objects.update_or_create(
+        name=normalize_name(name),
+        defaults={"latitude": coordinates[0], "longitude": coordinates[1]},
+    )
+    cache.set(_cache_key(normalize_name(name)), coordinates, settings.GEOCODING_CACHE_TIMEOUT)
+    return coordinates
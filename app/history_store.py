@@ -0,0 +1,147 @@
+from datetime import timezone as dt_timezone
+
+import numpy as np
+from django.db import transaction
+
+FORMAT_VERSION = 1
+
+# One record per observation; a day of hourly data is 24 * 36 bytes
+OBSERVATION_DTYPE = np.dtype(
+    [
+        ("time", "<i8"),
+        ("temp", "<f4"),
+        ("feels_like", "<f4"),
+        ("humidity", "<f4"),
+        ("pressure", "<f4"),
+        ("wind_speed", "<f4"),
+        ("wind_deg", "<f4"),
+        ("clouds", "<f4"),
+    ]
+)
+FIELDS = OBSERVATION_DTYPE.names[1:]
+
+_SOURCES = {
+    "temp": ("main", "temp"),
+    "feels_like": ("main", "feels_like"),
+    "humidity": ("main", "humidity"),
+    "pressure": ("main", "pressure"),
+    "wind_speed": ("wind", "speed"),
+    "wind_deg": ("wind", "deg"),
+    "clouds": ("clouds", "all"),
+}
+
+
+def encode(observations):
+    return bytes([FORMAT_VERSION]) + observations.astype(OBSERVATION_DTYPE, copy=False).tobytes()
+
+
+def decode(data):
+    data = bytes(data)
+    if not data:
+        return np.empty(0, dtype=OBSERVATION_DTYPE)
+    if data[0] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported weather series format {data[0]}")
+    return np.frombuffer(data, dtype=OBSERVATION_DTYPE, offset=1)
+
+
+def observation_from_weather(weather_data, observed_at):
+    observation = np.zeros(1, dtype=OBSERVATION_DTYPE)
+    observation["time"] = int(observed_at.timestamp())
+    for field, (section, name) in _SOURCES.items():
+        value = weather_data.get(section, {}).get(name)
+        observation[field] = np.nan if value is None else value
+    return observation
+
+
+def append_observation(city_id, observed_at, weather_data):
+    append_observations([(city_id, observed_at, weather_data)])
+
+
+def append_observations(observations):
+    # Takes (city_id, observed_at, weather_data) triples; a whole refresh chunk
+    # costs one insert, one locked read and one update rather than a round of
+    # queries per city
+    from .models import WeatherSeries
+
+    pending = {}
+    for city_id, observed_at, weather_data in observations:
+        key = (city_id, observed_at.astimezone(dt_timezone.utc).date())
+        pending.setdefault(key, []).append(observation_from_weather(weather_data, observed_at))
+    if not pending:
+        return
+
+    with transaction.atomic():
+        WeatherSeries.objects.bulk_create(
+            [WeatherSeries(city_id=city_id, day=day) for city_id, day in pending], ignore_conflicts=True
+        )
+        rows = WeatherSeries.objects.select_for_update().filter(
+            city_id__in={city_id for city_id, _ in pending}, day__in={day for _, day in pending}
+        )
+        updated = []
+        for series in rows:
+            new = pending.get((series.city_id, series.day))
+            if new is None:
+                continue
+            observations = np.concatenate([decode(series.observations), *new])
+            series.observations = encode(np.sort(observations, order="time", kind="stable"))
+            series.count = len(observations)
+            updated.append(series)
+        WeatherSeries.objects.bulk_update(updated, ["observations", "count"])
+
+
+def load_range(city_id, start, end):
+    from .models import WeatherSeries
+
+    rows = WeatherSeries.objects.filter(
+        city_id=city_id,
+        day__gte=start.astimezone(dt_timezone.utc).date(),
+        day__lte=end.astimezone(dt_timezone.utc).date(),
+    ).order_by("day")
+    arrays = [decode(observations) for observations in rows.values_list("observations", flat=True)]
+    if not arrays:
+        return np.empty(0, dtype=OBSERVATION_DTYPE)
+    observations = np.concatenate(arrays)
+    times = observations["time"]
+    return observations[(times >= int(start.timestamp())) & (times <= int(end.timestamp()))]
+
+
+def downsample(observations, seconds):
+    # Averages every field over fixed buckets, ignoring missing values
+    if len(observations) == 0:
+        return observations
+    buckets, inverse = np.unique(observations["time"] // seconds, return_inverse=True)
+    result = np.zeros(len(buckets), dtype=OBSERVATION_DTYPE)
+    result["time"] = buckets * seconds
+    for field in FIELDS:
+        values = observations[field]
+        present = ~np.isnan(values)
+        sums = np.bincount(inverse, weights=np.where(present, values, 0), minlength=len(buckets))
+        counts = np.bincount(inverse, weights=present, minlength=len(buckets))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result[field] = sums / counts
+    return result
+
+
+def daily_aggregates(city_id, start_day, end_day, field="temp"):
+    from .models import WeatherSeries
+
+    aggregates = []
+    rows = WeatherSeries.objects.filter(
+        city_id=city_id, day__gte=start_day, day__lte=end_day
+    ).order_by("day")
+    for day, data in rows.values_list("day", "observations"):
+        values = decode(data)[field]
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            continue
+        aggregates.append(
+            {
+                "day": day,
+                "min": float(values.min()),
+                "max": float(values.max()),
+                "mean": float(values.mean()),
+                "count": len(values),
+            }
+        )
+    return aggregates
+
@@ -0,0 +1,154 @@
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import uuid
+import weakref
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueListener
+
+from celery.signals import task_postrun, task_prerun
+
+correlation_id = ContextVar("correlation_id", default="-")
+
+# Pass as `extra=` on high-volume success events; they are kept at LOG_SAMPLE_RATE
+SAMPLED = {"sampled": True}
+
+
+class CorrelationIdFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False):
+            return True
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlation_id": getattr(record, "correlation_id", "-"),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for room, a full queue must not stop the shutdown
+        self.queue.put(self._sentinel)
+
+
+_queue_handlers = weakref.WeakSet()
+
+
+class QueueListenerHandler(logging.Handler):
+    # Callers only put the record on a bounded queue; a background thread formats
+    # and writes it to `targets`. When the writer falls behind, records are
+    # dropped rather than blocking the request or task
+    def __init__(self, targets, queue_size=10000, respect_handler_level=True):
+        super().__init__()
+        # dictConfig hands over a ConvertingList, which resolves cfg:// on indexing
+        self.targets = [targets[i] for i in range(len(targets))]
+        self.queue_size = queue_size
+        self.respect_handler_level = respect_handler_level
+        self.dropped = 0
+        self._start()
+        _queue_handlers.add(self)
+
+    def _start(self):
+        self.queue = queue.Queue(self.queue_size)
+        self.listener = _Listener(
+            self.queue, *self.targets, respect_handler_level=self.respect_handler_level
+        )
+        self.listener.start()
+
+    def _running(self):
+        return self.listener._thread is not None
+
+    def _restart_after_fork(self):
+        # The writer thread doesn't survive fork, so prefork workers start their own
+        if self._running():
+            self.dropped = 0
+            self._start()
+
+    def prepare(self, record):
+        # Merge the arguments now so nothing mutable crosses to the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        # Stopping the listener drains the queue; a fresh one takes over
+        if self._running():
+            self.listener.stop()
+            self._start()
+
+    def close(self):
+        # Called by logging.shutdown at exit, after a final flush
+        if self._running():
+            self.listener.stop()
+        super().close()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(
+        after_in_child=lambda: [handler._restart_after_fork() for handler in list(_queue_handlers)]
+    )
+
+
+class CorrelationIdMiddleware:
+    header = "X-Request-ID"
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_id = request.headers.get(self.header) or uuid.uuid4().hex
+        token = correlation_id.set(request_id[:64])
+        try:
+            response = self.get_response(request)
+        finally:
+            correlation_id.reset(token)
+        response[self.header] = request_id[:64]
+        return response
+
+
+_task_tokens = {}
+
+
+@task_prerun.connect
+def _set_task_correlation_id(task_id, **kwargs):
+    _task_tokens[task_id] = correlation_id.set(task_id)
+
+
+@task_postrun.connect
+def _reset_task_correlation_id(task_id, **kwargs):
+    token = _task_tokens.pop(task_id, None)
+    if token is not None:
+        correlation_id.reset(token)
@@ -0,0 +1,143 @@
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+from .utils import chunked
+
+# Errors after which the connection is considered dead and is reopened
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class DeliveryReport:
+    def __init__(self):
+        self.results = []
+        self.elapsed = 0.0
+
+    def add(self, message, error=None):
+        self.results.append((message, error))
+
+    @property
+    def sent(self):
+        return [message for message, error in self.results if error is None]
+
+    @property
+    def failed(self):
+        return [(message, error) for message, error in self.results if error is not None]
+
+    @property
+    def throughput(self):
+        return len(self.results) / self.elapsed if self.elapsed else 0.0
+
+
+class SMTPConnectionPool:
+    def __init__(self, size=None, batch_size=None, **connection_kwargs):
+        self.size = size or settings.EMAIL_POOL_SIZE
+        self.batch_size = batch_size or settings.EMAIL_BATCH_SIZE
+        self.connection_kwargs = connection_kwargs
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                connection = get_connection(fail_silently=False, **self.connection_kwargs)
+                connection.open()
+            except Exception:
+                # A failed connect must not use up a slot, or later callers wait forever
+                with self._lock:
+                    self._created -= 1
+                raise
+            return connection
+        try:
+            return self._idle.get(timeout=settings.EMAIL_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError("No SMTP connection became available") from None
+
+    def _release(self, connection):
+        self._idle.put(connection)
+
+    def _reconnect(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        connection.open()
+
+    def _send_one(self, connection, message):
+        try:
+            connection.send_messages([message])
+        except CONNECTION_ERRORS:
+            self._reconnect(connection)
+            connection.send_messages([message])
+
+    def _send_batch(self, messages):
+        try:
+            connection = self._acquire()
+        except Exception as e:
+            # Every message in the batch fails, the rest of the chunk still goes out
+            return [(message, e) for message in messages]
+        results = []
+        try:
+            for message in messages:
+                try:
+                    self._send_one(connection, message)
+                    results.append((message, None))
+                except Exception as e:
+                    results.append((message, e))
+        finally:
+            self._release(connection)
+        return results
+
+    def send_messages(self, messages):
+        report = DeliveryReport()
+        started = time.perf_counter()
+        batches = list(chunked(messages, self.batch_size))
+
+        if len(batches) <= 1:
+            batch_results = [self._send_batch(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=self.size) as executor:
+                batch_results = list(executor.map(self._send_batch, batches))
+
+        for results in batch_results:
+            for message, error in results:
+                report.add(message, error)
+        report.elapsed = time.perf_counter() - started
+        return report
+
+    def close(self):
+        with self._lock:
+            while True:
+                try:
+                    connection = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+                self._created -= 1
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = SMTPConnectionPool()
+    return _pool
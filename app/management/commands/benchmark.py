@@ -0,0 +1,71 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from app import benchmark
+
+
+class Command(BaseCommand):
+    help = "Time the email, refresh and weather endpoint paths on synthetic data against local stand-ins"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--cities", type=int, default=50)
+        parser.add_argument("--subscriptions-per-user", type=int, default=3)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--baseline", default=str(benchmark.BASELINE_PATH))
+        parser.add_argument("--tolerance", type=float, default=0.25)
+        parser.add_argument(
+            "--timings",
+            choices=["auto", "always", "never"],
+            default="auto",
+            help="Compare timings too; auto only does so against a baseline saved on this host",
+        )
+        parser.add_argument("--save-baseline", action="store_true")
+
+    def handle(self, *args, **options):
+        # Synthetic data goes into a throwaway test database, never the real one
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = benchmark.run(
+                users=options["users"],
+                cities=options["cities"],
+                subscriptions_per_user=options["subscriptions_per_user"],
+                repeat=options["repeat"],
+                requests=options["requests"],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name}: {result['throughput']} items/s, p50 {result['p50_ms']}ms, "
+                f"p99 {result['p99_ms']}ms, {result['queries']} queries"
+            )
+        self.stdout.write(json.dumps(results, indent=2))
+
+        if options["save_baseline"]:
+            benchmark.save_baseline(results, options["baseline"])
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved to {options['baseline']}"))
+            return
+
+        try:
+            baseline_host, baseline = benchmark.load_baseline(options["baseline"])
+        except FileNotFoundError:
+            self.stdout.write(self.style.WARNING(f"No baseline at {options['baseline']}"))
+            return
+        timings = options["timings"] == "always" or (
+            options["timings"] == "auto" and baseline_host == benchmark.host()
+        )
+        if not timings:
+            source = baseline_host or "an unknown host"
+            self.stdout.write(f"Comparing query counts only, the baseline is from {source}")
+        regressions = benchmark.compare(results, baseline, options["tolerance"], timings)
+        if regressions:
+            raise CommandError("Performance regressions:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
@@ -0,0 +1,28 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from app.bulk import export_rows, write_rows
+
+
+class Command(BaseCommand):
+    help = "Stream users and subscriptions to a CSV or JSONL file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default="-", help="File to write, or - for stdout")
+        parser.add_argument("--format", choices=["csv", "jsonl"])
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options["output"]
+        format = options["format"] or ("csv" if Path(path).suffix == ".csv" else "jsonl")
+        started = time.perf_counter()
+        if path == "-":
+            write_rows(export_rows(options["chunk_size"]), self.stdout, format)
+            return
+
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            count = write_rows(export_rows(options["chunk_size"]), file, format)
+        rate = count / max(time.perf_counter() - started, 1e-9)
+        self.stdout.write(self.style.SUCCESS(f"Exported {count} rows at {rate:.0f} rows/s"))
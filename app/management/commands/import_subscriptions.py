@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from app.bulk import SubscriptionImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = "Stream users and subscriptions from a CSV or JSONL file into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to read, or - for stdin")
+        parser.add_argument("--format", choices=["csv", "jsonl"])
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or ("csv" if Path(path).suffix == ".csv" else "jsonl")
+        file = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        importer = SubscriptionImporter(batch_size=options["batch_size"])
+        try:
+            for report in importer.run(read_rows(file, format)):
+                self.stdout.write(f"{report.rows} rows at {report.rows_per_second:.0f} rows/s")
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+        report = importer.report
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {report.users} users and {report.subscriptions} subscriptions "
+                f"from {report.rows} rows ({report.skipped} skipped) at {report.rows_per_second:.0f} rows/s"
+            )
+        )
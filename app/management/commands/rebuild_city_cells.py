@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.geo import grid_cell
+from app.models import City
+
+
+class Command(BaseCommand):
+    help = "Recompute the grid cell of every located city, after the grid or WEATHER_SHARED_RADIUS_KM changed"
+
+    def handle(self, *args, **options):
+        cities = list(City.objects.filter(latitude__isnull=False, longitude__isnull=False))
+        for city in cities:
+            city.cell = grid_cell(city.latitude, city.longitude, settings.WEATHER_SHARED_RADIUS_KM)
+        City.objects.bulk_update(cities, ["cell"], batch_size=1000)
+        self.stdout.write(self.style.SUCCESS(f"Updated {len(cities)} cities"))
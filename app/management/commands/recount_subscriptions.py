@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app.signals import recount_counters
+
+
+class Command(BaseCommand):
+    help = "Recount the users' subscription and the cities' subscriber counters"
+
+    def handle(self, *args, **options):
+        users, cities = recount_counters()
+        self.stdout.write(self.style.SUCCESS(f"Recounted {users} users and {cities} cities"))
@@ -0,0 +1,94 @@
+import os
+import time
+
+from celery.signals import task_postrun, task_prerun, worker_init, worker_process_shutdown
+from django.conf import settings
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+
+TASK_DURATION = Histogram(
+    "weather_task_duration_seconds",
+    "Celery task run time",
+    ["task", "state"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+API_LATENCY = Histogram(
+    "weather_api_request_duration_seconds",
+    "Weather provider HTTP request time",
+    ["provider", "outcome"],
+)
+API_REJECTED = Counter(
+    "weather_api_rejected_total",
+    "Weather provider calls held back by the rate limiter, quota or circuit breaker",
+    ["provider"],
+)
+EMAILS = Counter("weather_emails_total", "Weather emails by outcome", ["outcome"])
+CACHE_REQUESTS = Counter(
+    "weather_cache_requests_total", "Cache lookups by cache and result", ["cache", "result"]
+)
+DUE_SUBSCRIPTIONS = Gauge(
+    "weather_due_subscriptions",
+    "Subscriptions claimed by the last delivery run",
+    multiprocess_mode="mostrecent",
+)
+REFRESH_LAG = Histogram(
+    "weather_refresh_lag_seconds",
+    "Age of a city's weather snapshot when it is refreshed",
+    buckets=(300, 900, 1800, 3600, 2 * 3600, 6 * 3600, 12 * 3600, 24 * 3600, 48 * 3600),
+)
+
+
+def registry():
+    # Gunicorn and prefork Celery children each keep their own values; with
+    # PROMETHEUS_MULTIPROC_DIR set they are merged from the shared directory
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def render():
+    return generate_latest(registry())
+
+
+def count_cache(cache_name, hits, misses):
+    if hits:
+        CACHE_REQUESTS.labels(cache_name, "hit").inc(hits)
+    if misses:
+        CACHE_REQUESTS.labels(cache_name, "miss").inc(misses)
+
+
+_task_started = {}
+
+
+@task_prerun.connect
+def _start_task_timer(task_id, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def _observe_task(task_id, task, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+
+
+@worker_init.connect
+def _serve_worker_metrics(**kwargs):
+    if settings.CELERY_METRICS_PORT:
+        start_http_server(settings.CELERY_METRICS_PORT, registry=registry())
+
+
+@worker_process_shutdown.connect
+def _mark_worker_process_dead(pid=None, **kwargs):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -8,17 +8,23 @@ from django.contrib.auth.models import AbstractUser
 import uuid
 
 from django.utils import timezone
-from geopy.geocoders import Nominatim
+
+from .geo import CityIndex, grid_cell, neighbor_cells
+from .geocoding import geocode, geocode_offline
+from .history_store import append_observations
+from .weather_cache import store_weather
 
 
 class CustomUser(AbstractUser):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # Maintained by app.signals
+    subscriptions_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return f"{self.username}"
 
     def check_subscriptions_amount(self):
-        if self.subscriptions.count() >= 5:
+        if self.subscriptions_count >= 5:
             raise ValidationError("You can't add more than 5 subscriptions!")
         return True
 
@@ -49,41 +55,100 @@ class Subscription(models.Model):
         unique_together = ("user", "city")
         indexes = [
             models.Index(fields=["user", "city"]),
+            models.Index(fields=["is_active", "next_message"]),
         ]
         ordering = ["-city"]
 
     def __str__(self):
         return f"{self.user.username} - {self.city.name} - {self.next_message}"
 
-    def save(self, *args, **kwargs):
+    @property
+    def delivery_offset(self):
+        # Stable minute within the hour, so deliveries are spread over the hour
+        # instead of all firing at :00
+        return timedelta(minutes=self.id.int % 60)
+
+    def reschedule(self):
         if self.next_message <= timezone.now():
-            self.next_message = (
-                timezone.now()
-                + timedelta(hours=self.period)
-                - timedelta(
-                    minutes=timezone.now().minute,
-                    seconds=timezone.now().second,
-                    microseconds=timezone.now().microsecond,
-                )
-            )
+            top_of_hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+            self.next_message = top_of_hour + timedelta(hours=self.period) + self.delivery_offset
 
+    def save(self, *args, **kwargs):
+        self.reschedule()
         super(Subscription, self).save(*args, **kwargs)
 
+    def following_message(self, now):
+        # First slot after now; slots missed while deliveries were down are skipped
+        period = timedelta(hours=self.period)
+        missed = (now - self.next_message) // period
+        slot = self.next_message + (missed + 1) * period
+        slot = slot.replace(minute=0, second=0, microsecond=0) + self.delivery_offset
+        # Rows created before offsets existed may land back in the past
+        return slot if slot > now else slot + period
+
     def get_weather_data(self):
-        return self.city.data.first().weather_data
+        return self.city.current_weather.weather_data
 
 
 class City(models.Model):
+    class Status(models.TextChoices):
+        PENDING = "pending", "Pending"
+        RESOLVED = "resolved", "Resolved"
+        NOT_FOUND = "not_found", "Not found"
+
     name = models.CharField(max_length=124)
     longitude = models.FloatField(null=True, blank=True)
     latitude = models.FloatField(null=True, blank=True)
+    cell = models.CharField(max_length=32, blank=True, db_index=True)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.RESOLVED)
+    # Maintained by app.signals
+    subscribers_count = models.PositiveIntegerField(default=0, editable=False)
+    # Latest snapshot, so hot paths read it with a join instead of sorting data
+    current_weather = models.OneToOneField(
+        "WeatherData", on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
 
     def __str__(self):
         return f"{self.name}"
 
-    def set_coordinates(self):
-        location = Nominatim(user_agent=settings.env('NOMINATUM_ACCOUNT_NAME')).geocode(self.name)
-        self.latitude, self.longitude = location.latitude, location.longitude
+    @property
+    def is_pending(self):
+        return self.status == self.Status.PENDING
+
+    def set_coordinates(self, coordinates=None):
+        coordinates = coordinates or geocode(self.name)
+        if coordinates is None:
+            raise ValidationError(f"City {self.name} not found")
+        self.latitude, self.longitude = coordinates
+        self.cell = grid_cell(self.latitude, self.longitude, settings.WEATHER_SHARED_RADIUS_KM)
+        self.status = self.Status.RESOLVED
+
+    @classmethod
+    def find_nearby(cls, latitude, longitude, radius_km=None):
+        radius_km = radius_km or settings.WEATHER_SHARED_RADIUS_KM
+        candidates = cls.objects.filter(cell__in=neighbor_cells(latitude, longitude, radius_km))
+        nearby = CityIndex(candidates).within(latitude, longitude, radius_km)
+        return min(nearby, key=lambda city: city.pk, default=None)
+
+    @classmethod
+    def for_name(cls, name):
+        city = cls.objects.filter(name__iexact=name).first()
+        if city is not None:
+            return city
+
+        coordinates = geocode_offline(name)
+        if coordinates is None:
+            # Resolved in the background by tasks.resolve_city
+            return cls.objects.create(name=name, status=cls.Status.PENDING)
+
+        city = cls(name=name)
+        city.set_coordinates(coordinates)
+        # Another spelling of a place we already track shares its weather
+        nearby = cls.find_nearby(city.latitude, city.longitude)
+        if nearby is not None:
+            return nearby
+        city.save()
+        return city
 
 
 class WeatherData(models.Model):
@@ -92,10 +157,98 @@ class WeatherData(models.Model):
     updated_at = models.DateTimeField(auto_now_add=True)
     weather_data = models.JSONField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["city", "-updated_at"]),
+        ]
+        get_latest_by = "updated_at"
+
     def __str__(self):
         return f"{self.city.name} - {self.updated_at}"
 
-    def update_data(self, data):
+    def save(self, *args, record=True, **kwargs):
+        adding = self._state.adding
+        super(WeatherData, self).save(*args, **kwargs)
+        if adding:
+            City.objects.filter(id=self.city_id).update(current_weather=self)
+            if record:
+                self.record_observation()
+        store_weather(self)
+
+    def update_data(self, data, record=True):
         self.weather_data = data
         self.updated_at = timezone.now()
         self.save()
+        if record:
+            self.record_observation()
+
+    def record_observation(self):
+        # Once per fetched snapshot: on create and on update_data, not on every save
+        self.record_observations([self])
+
+    @classmethod
+    def record_observations(cls, snapshots):
+        # The refresh passes record=False and hands the whole chunk over here.
+        # WeatherSeries is the long-term record; the raw JSON is only kept for
+        # WEATHER_RAW_HISTORY_RETENTION_DAYS to debug provider payloads
+        snapshots = [s for s in snapshots if s.weather_data and "error" not in s.weather_data]
+        WeatherHistory.objects.bulk_create(
+            WeatherHistory(
+                city_id=s.city_id,
+                observed_at=s.updated_at,
+                partition=s.updated_at.date(),
+                weather_data=s.weather_data,
+            )
+            for s in snapshots
+        )
+        append_observations(
+            (s.city_id, s.updated_at, s.weather_data) for s in snapshots if "main" in s.weather_data
+        )
+
+
+class WeatherHistory(models.Model):
+    # Raw provider payloads, append-only and short-lived; rows are grouped into
+    # daily partitions so the retention sweeper drops whole days through the
+    # partition index. Long-term observations live in WeatherSeries
+    city = models.ForeignKey("City", on_delete=models.CASCADE, related_name="history")
+    observed_at = models.DateTimeField()
+    partition = models.DateField(db_index=True)
+    weather_data = models.JSONField()
+
+    class Meta:
+        verbose_name_plural = "Weather history"
+        indexes = [
+            models.Index(fields=["city", "observed_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.city_id} - {self.observed_at}"
+
+    def save(self, *args, **kwargs):
+        self.partition = self.observed_at.date()
+        super(WeatherHistory, self).save(*args, **kwargs)
+
+
+class WeatherSeries(models.Model):
+    # One day of observations per city as packed NumPy records, see history_store
+    city = models.ForeignKey("City", on_delete=models.CASCADE, related_name="series")
+    day = models.DateField()
+    observations = models.BinaryField(default=bytes)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "Weather series"
+        unique_together = ("city", "day")
+
+    def __str__(self):
+        return f"{self.city_id} - {self.day}"
+
+
+class GeocodedName(models.Model):
+    name = models.CharField(max_length=124, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name}"
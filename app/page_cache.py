@@ -0,0 +1,30 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.middleware.csrf import get_token
+
+
+def _version_key(user_id):
+    return f"main-page:{user_id}:version"
+
+
+def main_page_version(user_id):
+    # A fresh version on a miss means an evicted key can never bring back an
+    # old fragment
+    return cache.get_or_set(_version_key(user_id), time.time_ns, None)
+
+
+def invalidate_main_page(*user_ids):
+    # After commit, so a concurrent render can't cache the old rows again
+    transaction.on_commit(
+        lambda: cache.set_many({_version_key(user_id): time.time_ns() for user_id in user_ids}, None)
+    )
+
+
+def csrf_digest(request):
+    # The cached forms carry a masked token, which stays valid for as long as
+    # the CSRF secret it was made from
+    get_token(request)
+    return hashlib.sha256(request.META["CSRF_COOKIE"].encode()).hexdigest()[:16]
@@ -0,0 +1,111 @@
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    # Samples one thread's stack from a background thread, so the profiled code
+    # runs unmodified. Output is in the collapsed format read by flamegraph.pl
+    # and speedscope: one "outer;inner count" line per distinct stack
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = Counter()
+        self.path = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            self.stacks[_collapse(frame)] += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def write(self, label):
+        directory = Path(settings.PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r"[^\w.-]+", "_", label).strip("_") or "root"
+        self.path = directory / f"{slug}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.folded"
+        self.path.write_text(self.collapsed())
+        return self.path
+
+
+@contextmanager
+def profile(label):
+    profiler = SamplingProfiler(settings.PROFILE_INTERVAL).start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        if profiler.stacks:
+            profiler.write(label)
+
+
+class ProfilerMiddleware:
+    # Only installed with PROFILING on; then every request, or just those sent
+    # with an X-Profile header, is sampled into PROFILE_DIR
+    header = "X-Profile"
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not (settings.PROFILE_ALL_REQUESTS or request.headers.get(self.header)):
+            return self.get_response(request)
+        with profile(f"{request.method}-{request.path}") as profiler:
+            response = self.get_response(request)
+        if profiler.stacks:
+            response["X-Profile-Output"] = profiler.path.name
+        return response
+
+
+_task_profilers = {}
+
+
+def _profiles_task(name):
+    return settings.PROFILING and ("*" in settings.PROFILE_TASKS or name in settings.PROFILE_TASKS)
+
+
+@task_prerun.connect
+def _start_task_profiler(task_id, task, **kwargs):
+    if _profiles_task(task.name):
+        _task_profilers[task_id] = SamplingProfiler(settings.PROFILE_INTERVAL).start()
+
+
+@task_postrun.connect
+def _stop_task_profiler(task_id, task, **kwargs):
+    profiler = _task_profilers.pop(task_id, None)
+    if profiler is not None:
+        profiler.stop()
+        if profiler.stacks:
+            profiler.write(task.name)
@@ -0,0 +1,175 @@
+import time
+
+import openmeteo_requests
+import requests
+from django.conf import settings
+from openmeteo_sdk.Variable import Variable
+
+from .fetcher import WeatherFetcher
+from .metrics import API_LATENCY, API_REJECTED
+from .ratelimit import ApiGuard
+from .utils import chunked
+
+# WMO weather interpretation codes used by Open-Meteo
+WMO_DESCRIPTIONS = {
+    0: "clear sky",
+    1: "mainly clear",
+    2: "partly cloudy",
+    3: "overcast",
+    45: "fog",
+    48: "depositing rime fog",
+    51: "light drizzle",
+    53: "moderate drizzle",
+    55: "dense drizzle",
+    56: "light freezing drizzle",
+    57: "dense freezing drizzle",
+    61: "slight rain",
+    63: "moderate rain",
+    65: "heavy rain",
+    66: "light freezing rain",
+    67: "heavy freezing rain",
+    71: "slight snow fall",
+    73: "moderate snow fall",
+    75: "heavy snow fall",
+    77: "snow grains",
+    80: "slight rain showers",
+    81: "moderate rain showers",
+    82: "violent rain showers",
+    85: "slight snow showers",
+    86: "heavy snow showers",
+    95: "thunderstorm",
+    96: "thunderstorm with slight hail",
+    99: "thunderstorm with heavy hail",
+}
+
+
+class WeatherProvider:
+    name = None
+
+    # Maps {key: (latitude, longitude)} to {key: weather data in OpenWeatherMap layout},
+    # failed locations get {"error": ...} instead. `rate_wait` caps the seconds
+    # spent waiting on the rate limiter, None for WEATHER_API_RATE_WAIT
+    def fetch_many(self, locations, rate_wait=None):
+        raise NotImplementedError
+
+    def fetch(self, latitude, longitude, rate_wait=None):
+        return self.fetch_many({0: (latitude, longitude)}, rate_wait)[0]
+
+
+class OpenWeatherMapProvider(WeatherProvider):
+    name = "openweathermap"
+
+    def __init__(self, fetcher=None):
+        self.fetcher = fetcher or WeatherFetcher()
+
+    def fetch_many(self, locations, rate_wait=None):
+        return self.fetcher.fetch_many(locations, rate_wait)
+
+
+class _TimeoutSession(requests.Session):
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+class OpenMeteoProvider(WeatherProvider):
+    name = "open-meteo"
+    current_variables = (
+        "temperature_2m",
+        "apparent_temperature",
+        "relative_humidity_2m",
+        "pressure_msl",
+        "wind_speed_10m",
+        "wind_direction_10m",
+        "wind_gusts_10m",
+        "cloud_cover",
+        "weather_code",
+    )
+
+    def __init__(self, url=None, batch_size=None, timeout=None, guard=None):
+        self.url = url or settings.OPEN_METEO_API_URL
+        self.batch_size = batch_size or settings.OPEN_METEO_BATCH_SIZE
+        self.guard = guard or ApiGuard(self.name)
+        self.client = openmeteo_requests.Client(
+            session=_TimeoutSession(timeout or settings.WEATHER_API_TIMEOUT)
+        )
+
+    def fetch_many(self, locations, rate_wait=None):
+        results = {}
+        for batch in chunked(list(locations), self.batch_size):
+            params = {
+                "latitude": ",".join(str(locations[key][0]) for key in batch),
+                "longitude": ",".join(str(locations[key][1]) for key in batch),
+                "current": ",".join(self.current_variables),
+                "wind_speed_unit": "ms",
+            }
+            reason = self.guard.admit(wait=rate_wait)
+            if reason is not None:
+                API_REJECTED.labels(self.name).inc()
+                results.update((key, {"error": reason}) for key in batch)
+                continue
+            started = time.perf_counter()
+            try:
+                responses = self.client.weather_api(self.url, params=params)
+            except Exception as e:
+                API_LATENCY.labels(self.name, "error").observe(time.perf_counter() - started)
+                self.guard.record(success=False)
+                results.update((key, {"error": f"Error fetching weather data: {e}"}) for key in batch)
+                continue
+            API_LATENCY.labels(self.name, "success").observe(time.perf_counter() - started)
+            self.guard.record(success=True)
+
+            for response in responses:
+                results[batch[response.LocationId()]] = self.normalize(response)
+            for key in batch:
+                results.setdefault(key, {"error": "Location missing from weather response"})
+        return results
+
+    @staticmethod
+    def normalize(response):
+        current = response.Current()
+        values = {}
+        for i in range(current.VariablesLength()):
+            variable = current.Variables(i)
+            values[variable.Variable()] = variable.Value()
+
+        data = {
+            "coord": {"lat": response.Latitude(), "lon": response.Longitude()},
+            "dt": current.Time(),
+            "main": {
+                "temp": round(values[Variable.temperature], 1),
+                "feels_like": round(values[Variable.apparent_temperature], 1),
+                "humidity": round(values[Variable.relative_humidity]),
+                "pressure": round(values[Variable.pressure_msl]),
+            },
+            "wind": {
+                "speed": round(values[Variable.wind_speed], 1),
+                "deg": round(values[Variable.wind_direction]),
+            },
+            "clouds": {"all": round(values[Variable.cloud_cover])},
+            "weather": [
+                {"description": WMO_DESCRIPTIONS.get(int(values[Variable.weather_code]), "unknown")}
+            ],
+        }
+        if Variable.wind_gusts in values:
+            data["wind"]["gust"] = round(values[Variable.wind_gusts], 1)
+        return data
+
+
+PROVIDERS = {
+    OpenWeatherMapProvider.name: OpenWeatherMapProvider,
+    OpenMeteoProvider.name: OpenMeteoProvider,
+}
+
+_provider = None
+
+
+def get_provider():
+    global _provider
+    if _provider is None:
+        _provider = PROVIDERS[settings.WEATHER_PROVIDER]()
+    return _provider
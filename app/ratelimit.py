@@ -0,0 +1,160 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+# Refills the bucket for the elapsed time and takes the tokens if there are
+# enough; returns how long the caller has to wait otherwise
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+def _uses_redis():
+    return settings.CACHES["default"]["BACKEND"].startswith("django_redis")
+
+
+class TokenBucket:
+    _local_lock = threading.Lock()
+
+    def __init__(self, name, rate, capacity):
+        self.key = f"ratelimit:{name}:bucket"
+        self.rate = rate
+        self.capacity = capacity
+
+    def _take_redis(self, tokens):
+        from django_redis import get_redis_connection
+
+        connection = get_redis_connection("default")
+        wait = connection.eval(
+            TOKEN_BUCKET_SCRIPT, 1, self.key, self.rate, self.capacity, time.time(), tokens
+        )
+        return float(wait)
+
+    def _take_local(self, tokens):
+        with self._local_lock:
+            now = time.time()
+            available, updated_at = cache.get(self.key, (self.capacity, now))
+            available = min(self.capacity, available + max(0, now - updated_at) * self.rate)
+            wait = 0.0
+            if available >= tokens:
+                available -= tokens
+            else:
+                wait = (tokens - available) / self.rate
+            cache.set(self.key, (available, now), int(self.capacity / self.rate) + 1)
+            return wait
+
+    def try_acquire(self, tokens=1):
+        return self._take_redis(tokens) if _uses_redis() else self._take_local(tokens)
+
+    def acquire(self, tokens=1, timeout=0):
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class Quota:
+    def __init__(self, name, daily, monthly):
+        self.name = name
+        self.limits = {"daily": daily, "monthly": monthly}
+
+    def _keys(self):
+        now = timezone.now()
+        return {
+            "daily": (f"ratelimit:{self.name}:day:{now:%Y-%m-%d}", 60 * 60 * 24 * 2),
+            "monthly": (f"ratelimit:{self.name}:month:{now:%Y-%m}", 60 * 60 * 24 * 32),
+        }
+
+    def consume(self, amount=1):
+        for period, (key, timeout) in self._keys().items():
+            limit = self.limits[period]
+            if not limit:
+                continue
+            cache.add(key, 0, timeout)
+            if cache.incr(key, amount) > limit:
+                return False
+        return True
+
+    def usage(self):
+        return {period: cache.get(key, 0) for period, (key, _) in self._keys().items()}
+
+
+class CircuitBreaker:
+    def __init__(self, name, threshold, window, reset_timeout):
+        self.failures_key = f"ratelimit:{name}:failures"
+        self.open_key = f"ratelimit:{name}:open"
+        self.threshold = threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+
+    def allow(self):
+        return cache.get(self.open_key) is None
+
+    def record_success(self):
+        cache.delete(self.failures_key)
+
+    def record_failure(self):
+        cache.add(self.failures_key, 0, self.window)
+        if cache.incr(self.failures_key) >= self.threshold:
+            cache.set(self.open_key, True, self.reset_timeout)
+            cache.delete(self.failures_key)
+
+
+class ApiGuard:
+    def __init__(self, provider_name, api_key=""):
+        name = f"{provider_name}:{hashlib.sha1(api_key.encode()).hexdigest()[:12]}"
+        self.bucket = TokenBucket(
+            name, settings.WEATHER_API_RATE_PER_SECOND, settings.WEATHER_API_BURST
+        )
+        self.quota = Quota(
+            name, settings.WEATHER_API_DAILY_QUOTA, settings.WEATHER_API_MONTHLY_QUOTA
+        )
+        self.breaker = CircuitBreaker(
+            name,
+            settings.WEATHER_API_FAILURE_THRESHOLD,
+            settings.WEATHER_API_FAILURE_WINDOW,
+            settings.WEATHER_API_CIRCUIT_RESET,
+        )
+
+    def admit(self, wait=None):
+        # Returns the reason the call may not go out, or None when it may. Waits
+        # up to `wait` seconds for a token, WEATHER_API_RATE_WAIT by default
+        if not self.breaker.allow():
+            return "Weather API paused after repeated failures"
+        if wait is None:
+            wait = settings.WEATHER_API_RATE_WAIT
+        if not self.bucket.acquire(timeout=wait):
+            return "Weather API rate limit reached"
+        if not self.quota.consume():
+            return "Weather API quota exhausted"
+        return None
+
+    def record(self, success):
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
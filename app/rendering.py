@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+
+# Order of the lines in the message; the bit position of a field in the mask
+# is its index here.
+MESSAGE_FIELDS = (
+    "temperature",
+    "feels_like",
+    "humidity",
+    "pressure",
+    "wind",
+    "wind_speed",
+    "cloudiness",
+    "precipitation",
+)
+
+LINE_RENDERERS = (
+    lambda data: f"Temperature: {data['main']['temp']}°C\n",
+    lambda data: f"Feels like: {data['main']['feels_like']}°C\n",
+    lambda data: f"Humidity: {data['main']['humidity']}%\n",
+    lambda data: f"Pressure: {data['main']['pressure']} hPa\n",
+    lambda data: f"Wind: {data['wind']['speed']} m/s at {data['wind']['deg']}°\n",
+    lambda data: f"Wind gusts: {data['wind']['gust']} m/s\n" if "gust" in data["wind"] else "",
+    lambda data: f"Cloudiness: {data['clouds']['all']}%\n",
+    lambda data: f"Precipitation: {data['weather'][0]['description']}\n",
+)
+
+
+def field_mask(subscription):
+    mask = 0
+    for bit, field in enumerate(MESSAGE_FIELDS):
+        if getattr(subscription, field):
+            mask |= 1 << bit
+    return mask
+
+
+def render_weather_message(city_name, weather_data, mask):
+    lines = [f"Weather forecast for {city_name}:\n"]
+    for bit, render_line in enumerate(LINE_RENDERERS):
+        if mask & (1 << bit):
+            lines.append(render_line(weather_data))
+    return "".join(lines)
+
+
+class MessageCache:
+    def __init__(self, max_size=None):
+        self.max_size = max_size or settings.WEATHER_MESSAGE_CACHE_SIZE
+        self._messages = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, city, weather, mask):
+        key = (city.pk, weather.updated_at.timestamp(), mask)
+        with self._lock:
+            message = self._messages.get(key)
+            if message is not None:
+                self._messages.move_to_end(key)
+                self.hits += 1
+                return message
+
+        message = render_weather_message(city.name, weather.weather_data, mask)
+        with self._lock:
+            self.misses += 1
+            self._messages[key] = message
+            if len(self._messages) > self.max_size:
+                self._messages.popitem(last=False)
+        return message
+
+    def clear(self):
+        with self._lock:
+            self._messages.clear()
+            self.hits = self.misses = 0
+
+
+message_cache = MessageCache()
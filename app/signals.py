@@ -0,0 +1,45 @@
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import City, CustomUser, Subscription
+
+
+def _adjust_counters(subscription, delta):
+    # Clamped, so a counter that was never backfilled can't fail the delete
+    CustomUser.objects.filter(id=subscription.user_id).update(
+        subscriptions_count=Greatest(F("subscriptions_count") + delta, 0)
+    )
+    City.objects.filter(id=subscription.city_id).update(
+        subscribers_count=Greatest(F("subscribers_count") + delta, 0)
+    )
+
+
+def _count_of(field):
+    counts = (
+        Subscription.objects.filter(**{field: OuterRef("pk")})
+        .order_by()
+        .values(field)
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    return Coalesce(Subquery(counts), Value(0))
+
+
+def recount_counters():
+    # Rebuilds both counters from the subscriptions table, one UPDATE each
+    users = CustomUser.objects.update(subscriptions_count=_count_of("user"))
+    cities = City.objects.update(subscribers_count=_count_of("city"))
+    return users, cities
+
+
+@receiver(post_save, sender=Subscription)
+def count_created_subscription(sender, instance, created, **kwargs):
+    if created:
+        _adjust_counters(instance, 1)
+
+
+@receiver(post_delete, sender=Subscription)
+def count_deleted_subscription(sender, instance, **kwargs):
+    _adjust_counters(instance, -1)
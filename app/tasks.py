@@ -1,101 +1,283 @@
-from django.core.mail import send_mail
-from celery import shared_task
-from django.db.models import Count
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.core.mail import EmailMessage
+from celery import chord, shared_task
+from django.db.models import Count, F, Min, Q
 from django.utils import timezone
 
-import WeatherReminder.settings
-from .models import Subscription, WeatherData, City
+from .models import Subscription, WeatherData, WeatherHistory, City
 from datetime import timedelta
 
-from .utils import get_weather_data_from_api
+from .geo import CityIndex
+from .log import SAMPLED
+from .mail import get_pool
+from .metrics import DUE_SUBSCRIPTIONS, EMAILS, REFRESH_LAG, count_cache
+from .page_cache import invalidate_main_page
+from .providers import get_provider
+from .rendering import field_mask, message_cache
+from .utils import chunked
+from . import weather_cache
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task()
-def update_weather_data_for_city(weather_id):
+def refresh_city_weather(city_id):
     try:
-        weather = WeatherData.objects.get(id=weather_id)
-        new_data = get_weather_data_from_api(
-            latitude=weather.city.latitude, longitude=weather.city.longitude
-        )
+        city = City.objects.get(id=city_id)
+    except City.DoesNotExist:
+        weather_cache.release_refresh_lock(city_id)
+        logger.warning("City with id %s does not exist", city_id)
+        return
+    weather_cache.refresh(city)
 
-        if "error" in new_data:
-            print(
-                f"Weather data for city {weather.city.name} hasn't been updated. Error: {new_data['error']}"
-            )
-        else:
-            weather.update_data(new_data)
-            weather.save()
-            print(f"Weather data for city {weather.city.name} updated")
 
-    except WeatherData.DoesNotExist:
-        print(f"Weather data with id {weather_id} does not exist")
+def _city_subscribers(city):
+    # Read after geocoding, which is slow enough for users to subscribe meanwhile;
+    # their pages show the city as "Locating..." until it resolves
+    return list(city.subscriptions.values_list("user_id", flat=True))
+
+
+@shared_task()
+def resolve_city(city_id):
+    try:
+        city = City.objects.get(id=city_id, status=City.Status.PENDING)
+    except City.DoesNotExist:
+        logger.warning("Pending city with id %s does not exist", city_id)
+        return
+
+    try:
+        city.set_coordinates()
+    except ValidationError:
+        subscribers = _city_subscribers(city)
+        with transaction.atomic():
+            city.status = City.Status.NOT_FOUND
+            city.save(update_fields=["status"])
+            # They could never deliver and would keep counting toward the limit;
+            # the city row stays so the name is rejected up front next time
+            city.subscriptions.all().delete()
+            invalidate_main_page(*subscribers)
+        logger.info("City %s not found, %d subscriptions removed", city.name, len(subscribers))
+        return
+
+    subscribers = _city_subscribers(city)
+    nearby = City.find_nearby(city.latitude, city.longitude)
+    if nearby is not None:
+        with transaction.atomic():
+            # Users already subscribed to the nearby city keep that subscription
+            Subscription.objects.filter(
+                city=city, user__subscriptions__city=nearby
+            ).delete()
+            moved = Subscription.objects.filter(city=city).update(city=nearby)
+            City.objects.filter(id=nearby.id).update(subscribers_count=F("subscribers_count") + moved)
+            city.delete()
+            invalidate_main_page(*subscribers)
+        logger.info("City %s merged into %s", city.name, nearby.name)
+        return
+
+    # Only what geocoding set: a full save would write back the counters and
+    # snapshot read before the lookup
+    city.save(update_fields=["latitude", "longitude", "cell", "status"])
+    invalidate_main_page(*subscribers)
+    data = get_provider().fetch(city.latitude, city.longitude)
+    if "error" in data:
+        logger.warning("Weather data for city %s does not created, error: %s", city.name, data["error"])
+    else:
+        WeatherData.objects.create(city=city, weather_data=data)
+        logger.info("City %s resolved", city.name)
 
 
 @shared_task()
 def update_weather_data_async():
-    update_interval = timezone.now() - timedelta(minutes=55)
-    outdated_weather_data = WeatherData.objects.filter(updated_at__lte=update_interval)
+    now = timezone.now()
+    horizon = now + timedelta(minutes=settings.WEATHER_PREFETCH_WINDOW)
+    max_age = timedelta(minutes=settings.WEATHER_PREFETCH_MAX_AGE)
+    idle_since = now - timedelta(hours=settings.WEATHER_IDLE_REFRESH_INTERVAL)
+    no_weather = Q(current_weather__isnull=True)
+    # Cities with a delivery inside the window get weather fresh enough for
+    # that delivery; cities nobody is subscribed to only on a slow cadence.
+    # Cities whose subscribers are due later are left until they come due
+    outdated_cities = (
+        City.objects.filter(latitude__isnull=False)
+        .annotate(
+            next_delivery=Min(
+                "subscriptions__next_message",
+                filter=Q(subscriptions__is_active=True, subscriptions__next_message__lte=horizon),
+            ),
+            active_subscribers=Count("subscriptions", filter=Q(subscriptions__is_active=True)),
+        )
+        .filter(
+            Q(next_delivery__isnull=False)
+            & (no_weather | Q(current_weather__updated_at__lt=F("next_delivery") - max_age))
+            | Q(active_subscribers=0) & (no_weather | Q(current_weather__updated_at__lte=idle_since))
+        )
+        .order_by("cell", "id")
+        .values_list("id", flat=True)
+    )
+    chunk_size = settings.WEATHER_REFRESH_CHUNK_SIZE
+    subtasks = [
+        refresh_weather_chunk.s(chunk)
+        for chunk in chunked(outdated_cities.iterator(chunk_size=chunk_size), chunk_size)
+    ]
+    if subtasks:
+        chord(subtasks)(summarize_weather_refresh.s())
+    logger.info("Weather refresh dispatched in %d chunks", len(subtasks))
 
-    for weather in outdated_weather_data:
-        update_weather_data_for_city.delay(weather.id)
 
-    cities_without_data = City.objects.annotate(num_weather_data=Count("data")).filter(
-        num_weather_data=0
+@shared_task()
+def refresh_weather_chunk(city_ids):
+    totals = {"updated": 0, "created": 0, "failed": 0}
+    cities = City.objects.select_related("current_weather").filter(id__in=city_ids)
+    clusters = CityIndex(cities).clusters(settings.WEATHER_SHARED_RADIUS_KM)
+    results = get_provider().fetch_many(
+        {city.id: (city.latitude, city.longitude) for city in clusters}
     )
 
-    for city in cities_without_data:
-        try:
-            WeatherData.objects.create(
-                city=city,
-                weather_data=get_weather_data_from_api(
-                    latitude=city.latitude, longitude=city.longitude
-                ),
-            )
-            print(f"Weather data for city {city.name} created")
-        except Exception as e:
-            print(f"Weather data for city {city.name} does not created, error: {e}")
+    now = timezone.now()
+    snapshots = []
+    for representative, members in clusters.items():
+        data = results[representative.id]
+        for city in members:
+            if city.current_weather is not None:
+                REFRESH_LAG.observe((now - city.current_weather.updated_at).total_seconds())
+            if "error" in data:
+                totals["failed"] += 1
+                logger.warning("Weather data for city %s hasn't been updated. Error: %s", city.name, data["error"])
+            elif city.current_weather is not None:
+                city.current_weather.update_data(data, record=False)
+                snapshots.append(city.current_weather)
+                totals["updated"] += 1
+                logger.info("Weather data for city %s updated", city.name, extra=SAMPLED)
+            else:
+                weather = WeatherData(city=city, weather_data=data)
+                weather.save(record=False)
+                snapshots.append(weather)
+                totals["created"] += 1
+                logger.info("Weather data for city %s created", city.name, extra=SAMPLED)
+    # One batch of history writes for the whole chunk
+    WeatherData.record_observations(snapshots)
+    totals["fetches"] = len(clusters)
+    return totals
+
+
+@shared_task()
+def summarize_weather_refresh(chunk_totals):
+    totals = {}
+    for chunk in chunk_totals:
+        for name, value in chunk.items():
+            totals[name] = totals.get(name, 0) + value
+    logger.info("Weather refresh finished: %s", totals)
+    return totals
 
 
 @shared_task()
 def send_weather_email():
-    subscriptions = Subscription.objects.filter(next_message__hour=timezone.now().hour)
+    now = timezone.now()
+    chunk_size = settings.WEATHER_EMAIL_CHUNK_SIZE
+    chunks = claimed = 0
+    while True:
+        with transaction.atomic():
+            # Rows locked by a concurrent run are skipped and the rest are claimed
+            # by moving next_message forward, so nothing is dispatched twice
+            due = list(
+                Subscription.objects.select_for_update(skip_locked=True)
+                .filter(is_active=True, next_message__lte=now)
+                .order_by("next_message")
+                .only("id", "period", "next_message")[:chunk_size]
+            )
+            if not due:
+                break
+            for subscription in due:
+                subscription.next_message = subscription.following_message(now)
+            Subscription.objects.bulk_update(due, ["next_message"])
+            subscription_ids = [str(subscription.id) for subscription in due]
+            transaction.on_commit(lambda ids=subscription_ids: send_weather_email_chunk.delay(ids))
+        chunks += 1
+        claimed += len(due)
+        if len(due) < chunk_size:
+            break
+    DUE_SUBSCRIPTIONS.set(claimed)
+    logger.info("Weather emails dispatched in %d chunks", chunks)
+
+
+@shared_task()
+def send_weather_email_chunk(subscription_ids):
+    subscriptions = list(
+        Subscription.objects.filter(id__in=subscription_ids, is_active=True)
+        .select_related("user", "city__current_weather")
+        .order_by()
+    )
+    api_email = settings.EMAIL_HOST_USER
+    messages = []
+    cache_hits, cache_misses = message_cache.hits, message_cache.misses
+
     for subscription in subscriptions:
         try:
-            api_email = WeatherReminder.settings.EMAIL_HOST_USER
-            weather_data = subscription.get_weather_data()
-            message = f"Weather forecast for {subscription.city.name}:\n"
-
-            if subscription.temperature:
-                message += f"Temperature: {weather_data['main']['temp']}°C\n"
-            if subscription.feels_like:
-                message += f"Feels like: {weather_data['main']['feels_like']}°C\n"
-            if subscription.humidity:
-                message += f"Humidity: {weather_data['main']['humidity']}%\n"
-            if subscription.pressure:
-                message += f"Pressure: {weather_data['main']['pressure']} hPa\n"
-            if subscription.wind:
-                message += f"Wind: {weather_data['wind']['speed']} m/s at {weather_data['wind']['deg']}°\n"
-            if subscription.wind_speed and "gust" in weather_data["wind"]:
-                message += f"Wind gusts: {weather_data['wind']['gust']} m/s\n"
-            if subscription.cloudiness:
-                message += f"Cloudiness: {weather_data['clouds']['all']}%\n"
-            if subscription.precipitation:
-                description = weather_data["weather"][0]["description"]
-                message += f"Precipitation: {description}\n"
-
-            send_mail(
+            weather = subscription.city.current_weather
+            if weather is None:
+                raise ValueError("no weather data for the city yet")
+            message = EmailMessage(
                 subject=f"{subscription.user.username}, here is your {subscription.city} weather forecast for closest hour",
-                message=f"{message}",
+                body=message_cache.render(subscription.city, weather, field_mask(subscription)),
                 from_email=f"{api_email}",
-                recipient_list=[f"{subscription.user.email}"],
-            )
-            print(
-                f"Weather to {subscription.user.username}, {subscription.city} was sent successfully"
+                to=[f"{subscription.user.email}"],
             )
+            message.subscription = subscription
+            messages.append(message)
         except Exception as e:
-            print(
-                f"Error sending weather email to subscription {subscription.user.username}, {subscription.city}: {str(e)}"
+            logger.warning(
+                "Error preparing weather email to subscription %s, %s: %s",
+                subscription.user.username,
+                subscription.city,
+                e,
             )
 
-        subscription.next_message += timedelta(hours=subscription.period)
-        subscription.save()
+    report = get_pool().send_messages(messages)
+    for message in report.sent:
+        logger.info(
+            "Weather to %s, %s was sent successfully",
+            message.subscription.user.username,
+            message.subscription.city,
+            extra=SAMPLED,
+        )
+    for message, error in report.failed:
+        logger.error(
+            "Error sending weather email to subscription %s, %s: %s",
+            message.subscription.user.username,
+            message.subscription.city,
+            error,
+        )
+    logger.info("Sent %d weather emails at %.1f messages/s", len(report.sent), report.throughput)
+
+    # Once per chunk, so the per-message loops stay free of metric updates
+    EMAILS.labels("sent").inc(len(report.sent))
+    EMAILS.labels("failed").inc(len(report.failed))
+    EMAILS.labels("skipped").inc(len(subscription_ids) - len(messages))
+    count_cache(
+        "message", message_cache.hits - cache_hits, message_cache.misses - cache_misses
+    )
+
+
+@shared_task()
+def sweep_weather_history():
+    today = timezone.now().date()
+    raw_cutoff = today - timedelta(days=settings.WEATHER_RAW_HISTORY_RETENTION_DAYS)
+    expired_partitions = (
+        WeatherHistory.objects.filter(partition__lt=raw_cutoff)
+        .order_by("partition")
+        .values_list("partition", flat=True)
+        .distinct()
+    )
+    for partition in list(expired_partitions):
+        deleted, _ = WeatherHistory.objects.filter(partition=partition).delete()
+        logger.info("Weather history partition %s removed, %d rows", partition, deleted)
+
+    # Snapshots replaced before current_weather existed are history too
+    cutoff = today - timedelta(days=settings.WEATHER_HISTORY_RETENTION_DAYS)
+    deleted, _ = WeatherData.objects.filter(
+        updated_at__date__lt=cutoff, city__current_weather__isnull=False
+    ).exclude(city__current_weather=F("id")).delete()
+    logger.info("Removed %d superseded weather snapshots", deleted)
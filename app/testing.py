@@ -0,0 +1,195 @@
+import json
+import socketserver
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import flatbuffers
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from openmeteo_sdk.Variable import Variable
+
+
+@contextmanager
+def query_budget(budget, using="default"):
+    # Fails when the block runs more than `budget` queries, listing them so an
+    # N+1 shows up in the test output
+    with CaptureQueriesContext(connections[using]) as queries:
+        yield queries
+    if len(queries) > budget:
+        raise AssertionError(
+            f"{len(queries)} queries, budget {budget}:\n"
+            + "\n".join(f"{i}. {query['sql']}" for i, query in enumerate(queries.captured_queries, 1))
+        )
+
+
+class _BackgroundServer:
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 localhost SMTP sink ready")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip()
+            verb = command[:4].upper()
+
+            if verb == "EHLO":
+                self.reply("250-localhost")
+                self.reply("250 8BITMIME")
+            elif verb == "HELO":
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                sender, recipients = command[10:].strip("<> "), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command[8:].strip("<> "))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    data.append(data_line)
+                self.server.messages.append((sender, recipients, b"".join(data)))
+                self.reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class LocalSMTPServer(_BackgroundServer, socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), _SMTPHandler)
+        self.messages = []
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class _WeatherHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        query = {name: values[-1] for name, values in parse_qs(urlparse(self.path).query).items()}
+        self.server.requests.append(query)
+        status, payload = self.server.responder(query)
+        if isinstance(payload, bytes):
+            body, content_type = payload, "application/octet-stream"
+        else:
+            body, content_type = json.dumps(payload).encode(), "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def openweathermap_responder(query):
+    latitude, longitude = float(query["lat"]), float(query["lon"])
+    return 200, {
+        "coord": {"lat": latitude, "lon": longitude},
+        "main": {"temp": 10.0, "feels_like": 9.0, "humidity": 60, "pressure": 1015},
+        "wind": {"speed": 2.5, "deg": 180},
+        "clouds": {"all": 20},
+        "weather": [{"description": "few clouds"}],
+    }
+
+
+def encode_open_meteo_response(location_id, latitude, longitude, current):
+    # Builds one size-prefixed WeatherApiResponse the way the Open-Meteo API
+    # streams them; `current` maps openmeteo_sdk Variable ids to values.
+    builder = flatbuffers.Builder(256)
+    variables = []
+    for variable, value in current.items():
+        builder.StartObject(3)
+        builder.PrependUint8Slot(0, variable, 0)
+        builder.PrependFloat32Slot(2, value, 0.0)
+        variables.append(builder.EndObject())
+
+    builder.StartVector(4, len(variables), 4)
+    for offset in reversed(variables):
+        builder.PrependUOffsetTRelative(offset)
+    variables_vector = builder.EndVector()
+
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, 1700000000, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables_vector, 0)
+    current_table = builder.EndObject()
+
+    builder.StartObject(10)
+    builder.PrependFloat32Slot(0, latitude, 0.0)
+    builder.PrependFloat32Slot(1, longitude, 0.0)
+    builder.PrependInt64Slot(4, location_id, 0)
+    builder.PrependUOffsetTRelativeSlot(9, current_table, 0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+def open_meteo_responder(query):
+    latitudes = [float(value) for value in query["latitude"].split(",")]
+    longitudes = [float(value) for value in query["longitude"].split(",")]
+    current = {
+        Variable.temperature: 10.0,
+        Variable.apparent_temperature: 9.0,
+        Variable.relative_humidity: 60.0,
+        Variable.pressure_msl: 1015.0,
+        Variable.wind_speed: 2.5,
+        Variable.wind_direction: 180.0,
+        Variable.wind_gusts: 5.0,
+        Variable.cloud_cover: 20.0,
+        Variable.weather_code: 2.0,
+    }
+    return 200, b"".join(
+        encode_open_meteo_response(i, latitude, longitude, current)
+        for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes))
+    )
+
+
+class LocalWeatherServer(_BackgroundServer, ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, responder=openweathermap_responder, host="127.0.0.1", port=0):
+        super().__init__((host, port), _WeatherHandler)
+        self.responder = responder
+        self.requests = []
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/data/2.5/weather"
@@ -1,17 +1,76 @@
 import json
+import math
+import logging
+import smtplib
+import tempfile
+import threading
+import time
 from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import skipUnless
+from unittest.mock import patch
 
-from django.test import TestCase, Client
+import numpy as np
+from prometheus_client import REGISTRY
+
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.http import HttpResponse
+from django.db import connection, connections, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from .models import Subscription, WeatherData, City
+from .models import Subscription, WeatherData, WeatherHistory, City, GeocodedName
+from .benchmark import compare, seed
+from .fetcher import WeatherFetcher
+from .forms import CreateSubscriptionForm
+from .geo import KM_PER_DEGREE, CityIndex, KDTree, grid_cell, haversine_km, neighbor_cells
+from .geocoding import geocode
+from .log import (
+    SAMPLED,
+    CorrelationIdFilter,
+    JsonFormatter,
+    QueueListenerHandler,
+    SamplingFilter,
+    correlation_id,
+)
+from .history_store import daily_aggregates, downsample, load_range
+from .weather_cache import acquire_refresh_lock, get_city_weather
+from .mail import SMTPConnectionPool
+from .profiling import ProfilerMiddleware, SamplingProfiler
+from .providers import OpenMeteoProvider, OpenWeatherMapProvider
+from .ratelimit import ApiGuard, Quota, TokenBucket
+from .rendering import MessageCache, field_mask
+from .tasks import (
+    refresh_weather_chunk,
+    resolve_city,
+    send_weather_email,
+    send_weather_email_chunk,
+    summarize_weather_refresh,
+    sweep_weather_history,
+    update_weather_data_async,
+)
+from .testing import (
+    LocalSMTPServer,
+    LocalWeatherServer,
+    open_meteo_responder,
+    openweathermap_responder,
+    query_budget,
+)
 
 User = get_user_model()
 
 
 class TestWeatherReminderViews(TestCase):
     def setUp(self):
+        cache.clear()
         self.client = Client()
         self.user = User.objects.create_user(username="testuser", password="Password123")
         self.username = "testuser"
@@ -92,10 +151,1218 @@ class TestWeatherReminderViews(TestCase):
         self.weather_data.updated_at = timezone.now() - timedelta(hours=2)
         self.weather_data.save()
 
-        with self.assertLogs("weather_reminder", level="INFO") as log:
+        with self.assertLogs("app.weather_cache", level="INFO") as log:
             response = self.client.get(self.get_weather_url)
 
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.content)
-        self.assertIn("INFO:weather_reminder:Updating weather data", log.output[0])
+        self.assertEqual(data["temp"], 25)
+        self.assertIn("INFO:app.weather_cache:Updating weather data", log.output[0])
+
+
+
+class TestMainPageCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="cached", password="Password123")
+        self.url = reverse("main", kwargs={"username": "cached"})
+        self.client.login(username="cached", password="Password123")
+
+    def subscribe(self, name):
+        return Subscription.objects.create(user=self.user, city=City.objects.create(name=name))
+
+    def test_query_count_does_not_grow_with_subscriptions(self):
+        self.subscribe("Calgary")
+        cache.clear()
+        with self.assertNumQueries(3) as one:
+            self.client.get(self.url)
+
+        for name in ("Banff", "Canmore", "Edmonton"):
+            self.subscribe(name)
+        cache.clear()
+        with self.assertNumQueries(len(one.captured_queries)):
+            response = self.client.get(self.url)
+        self.assertContains(response, "Edmonton")
+
+    def test_status_poll_refreshes_a_resolved_city_cached_elsewhere(self):
+        city = City.objects.create(name="YYC", status=City.Status.PENDING)
+        Subscription.objects.create(user=self.user, city=city)
+        self.assertContains(self.client.get(self.url), "data-status-url")
+
+        # Resolved by a worker whose cache bump this process never saw
+        City.objects.filter(id=city.id).update(status=City.Status.RESOLVED)
+        self.assertContains(self.client.get(self.url), "data-status-url")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse("city_status", kwargs={"city_id": city.id}))
+        self.assertNotContains(self.client.get(self.url), "data-status-url")
+
+    def test_create_at_the_limit_is_a_form_error(self):
+        for i in range(5):
+            self.subscribe(f"City {i}")
+
+        response = self.client.post(self.url, {"create_subscription": "1", "city": "Atlantis", "period": 6})
+
+        self.assertContains(response, "You can&#x27;t add more than 5 subscriptions!")
+        self.assertFalse(City.objects.filter(name="Atlantis").exists())
+
+    @patch("app.views.resolve_city")
+    @patch("app.geocoding.Nominatim")
+    def test_alias_of_a_followed_city_is_a_form_error(self, nominatim, task):
+        for first, alias in (("New York", "NYC"), ("Lethbridge", "lethbridge")):
+            self.client.post(self.url, {"create_subscription": "1", "city": first, "period": 6})
+
+            response = self.client.post(self.url, {"create_subscription": "1", "city": alias, "period": 6})
+
+            self.assertContains(response, f"You are already subscribed to {first}")
+        self.assertEqual(Subscription.objects.filter(user=self.user).count(), 2)
+
+    def test_cached_table_skips_subscription_query(self):
+        self.subscribe("Calgary")
+        self.client.get(self.url)
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertContains(response, "Calgary")
+
+    def test_toggle_and_delete_invalidate_cached_table(self):
+        subscription = self.subscribe("Calgary")
+        self.assertContains(self.client.get(self.url), "class=\"button\">True</button>", count=2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("change_attr", kwargs={"subscription_id": subscription.id, "attr": "is_active"}))
+        self.assertContains(self.client.get(self.url), "class=\"button\">True</button>", count=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("delete_subscription", kwargs={"subscription_id": subscription.id}))
+        self.assertNotContains(self.client.get(self.url), "Calgary")
+
+
+class TestSubscriptionCounters(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="counter", password="Password123")
+        self.cities = [City.objects.create(name=f"City {i}") for i in range(5)]
+
+    def test_counters_follow_create_and_delete(self):
+        subscriptions = [Subscription.objects.create(user=self.user, city=city) for city in self.cities[:3]]
+        other = User.objects.create_user(username="other", password="Password123")
+        Subscription.objects.create(user=other, city=self.cities[0])
+
+        subscriptions[1].delete()
+        other.delete()
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.subscriptions_count, 2)
+        self.assertEqual(
+            [city.subscribers_count for city in City.objects.order_by("id")[:3]], [1, 0, 1]
+        )
+
+    def test_limit_check_reads_the_counter(self):
+        for city in self.cities:
+            Subscription.objects.create(user=self.user, city=city)
+        self.user.refresh_from_db()
+
+        with self.assertNumQueries(0):
+            with self.assertRaises(ValidationError):
+                self.user.check_subscriptions_amount()
+
+    def test_recount_backfills_rows_created_before_the_counters(self):
+        subscription = Subscription.objects.create(user=self.user, city=self.cities[0])
+        Subscription.objects.create(user=self.user, city=self.cities[1])
+        User.objects.update(subscriptions_count=0)
+        City.objects.update(subscribers_count=0)
+
+        # A delete on a stale counter stays at 0 instead of failing the check constraint
+        subscription.delete()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.subscriptions_count, 0)
+
+        call_command("recount_subscriptions", stdout=StringIO())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.subscriptions_count, 1)
+        self.assertEqual(
+            [city.subscribers_count for city in City.objects.order_by("id")[:2]], [0, 1]
+        )
+
+    def test_merged_city_moves_its_subscribers(self):
+        calgary = City.objects.create(name="Calgary", latitude=51.05, longitude=-114.07)
+        calgary.set_coordinates((51.05, -114.07))
+        calgary.save()
+        pending = City.objects.create(name="YYC", status=City.Status.PENDING)
+        Subscription.objects.create(user=self.user, city=pending)
+
+        with patch("app.models.geocode", return_value=(51.05, -114.07)):
+            resolve_city(pending.id)
+
+        calgary.refresh_from_db()
+        self.assertEqual(calgary.subscribers_count, 1)
+
+    def test_admin_changelists_do_not_query_per_row(self):
+        admin = User.objects.create_superuser(username="admin", password="Password123")
+        self.client.force_login(admin)
+        for city in self.cities:
+            Subscription.objects.create(user=self.user, city=city)
+            WeatherData.objects.create(city=city, weather_data={"temp": 1})
+
+        for model in ("customuser", "subscription", "weatherdata"):
+            url = reverse(f"admin:app_{model}_changelist")
+            with self.assertNumQueries(5) as few:
+                self.client.get(url)
+            Subscription.objects.create(
+                user=User.objects.create_user(username=f"more-{model}"),
+                city=City.objects.create(name=f"More {model}"),
+            )
+            WeatherData.objects.create(city=City.objects.last(), weather_data={"temp": 1})
+            with self.assertNumQueries(len(few.captured_queries)):
+                self.client.get(url)
+
+
+class TestBulkImportExport(TestCase):
+    def setUp(self):
+        cache.clear()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = Path(tmpdir.name)
+
+    def write(self, name, content):
+        path = self.tmpdir / name
+        path.write_text(content)
+        return str(path)
+
+    def test_import_dedupes_cities_and_maintains_counters(self):
+        rows = [
+            {"username": "ann", "email": "ann@example.com", "city": "Calgary", "period": 3, "wind": True},
+            {"username": "ann", "city": "calgary"},
+            {"username": "bob", "email": "bob@example.com", "city": "CALGARY"},
+            {"username": "bob", "city": "Atlantis"},
+            {"username": "eve", "email": "eve@example.com"},
+        ]
+        path = self.write("import.jsonl", "".join(json.dumps(row) + "\n" for row in rows))
+
+        with patch("app.bulk.City.for_name", wraps=City.for_name) as for_name:
+            with self.captureOnCommitCallbacks() as callbacks:
+                call_command("import_subscriptions", path, "--batch-size", "2", stdout=StringIO())
+
+        self.assertEqual(for_name.call_count, 2)
+        # Two page invalidations and the pending city's resolve_city
+        self.assertEqual(len(callbacks), 3)
+        self.assertEqual(User.objects.count(), 3)
+        calgary = City.objects.get(name="Calgary")
+        self.assertEqual(calgary.subscribers_count, 2)
+        ann = User.objects.get(username="ann")
+        self.assertEqual(ann.subscriptions_count, 1)
+        subscription = ann.subscriptions.get()
+        self.assertEqual((subscription.period, subscription.wind), (3, True))
+        self.assertGreater(subscription.next_message, timezone.now())
+        self.assertFalse(ann.has_usable_password())
+
+    def test_import_refreshes_cached_main_page(self):
+        user = User.objects.create_user(username="ann", email="ann@example.com", password="Password123")
+        self.client.login(username="ann", password="Password123")
+        url = reverse("main", kwargs={"username": "ann"})
+        self.assertNotContains(self.client.get(url), "Calgary")
+
+        path = self.write("import.jsonl", json.dumps({"username": user.username, "city": "Calgary"}) + "\n")
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("import_subscriptions", path, stdout=StringIO())
+
+        self.assertContains(self.client.get(url), "Calgary")
+
+    def test_export_round_trips_through_csv(self):
+        user = User.objects.create_user(username="ann", email="ann@example.com", password="Password123")
+        Subscription.objects.create(user=user, city=City.objects.create(name="Calgary"), humidity=True)
+        User.objects.create_user(username="zed", email="zed@example.com", password="Password123")
+        path = str(self.tmpdir / "export.csv")
+
+        call_command("export_subscriptions", "--output", path, stdout=StringIO())
+        Subscription.objects.all().delete()
+        User.objects.all().delete()
+        call_command("import_subscriptions", path, stdout=StringIO())
+
+        ann = User.objects.get(username="ann")
+        self.assertTrue(ann.check_password("Password123"))
+        self.assertTrue(ann.subscriptions.get().humidity)
+        self.assertTrue(User.objects.filter(username="zed").exists())
+
+
+class TestBenchmark(TestCase):
+    baseline = {"send_weather_email": {"throughput": 100.0, "p50_ms": 10.0, "p99_ms": 20.0, "queries": 5}}
+
+    def test_compare_accepts_results_within_tolerance(self):
+        results = {"send_weather_email": {"throughput": 90.0, "p50_ms": 12.0, "p99_ms": 40.0, "queries": 5}}
+        self.assertEqual(compare(results, self.baseline, tolerance=0.25, timings=True), [])
+
+    def test_compare_reports_slower_runs_and_extra_queries(self):
+        results = {"send_weather_email": {"throughput": 50.0, "p50_ms": 20.0, "p99_ms": 40.0, "queries": 6}}
+        self.assertEqual(len(compare(results, self.baseline, tolerance=0.25, timings=True)), 3)
+
+    def test_compare_checks_only_queries_against_another_host(self):
+        results = {"send_weather_email": {"throughput": 50.0, "p50_ms": 20.0, "p99_ms": 40.0, "queries": 6}}
+        self.assertEqual(compare(results, self.baseline), ["send_weather_email: 6 queries, baseline 5"])
+
+    def test_seed_builds_consistent_counters(self):
+        seed(users=4, cities=3, subscriptions_per_user=2)
+        self.assertEqual(Subscription.objects.count(), 8)
+        self.assertEqual(set(User.objects.values_list("subscriptions_count", flat=True)), {2})
+        for city in City.objects.all():
+            self.assertEqual(city.subscribers_count, city.subscriptions.count())
+
+
+class TestMetrics(TestCase):
+    def sample(self, name, labels=None):
+        return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+    def test_metrics_endpoint_exposes_weather_metrics(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"weather_emails_total", response.content)
+
+    def test_email_chunk_counts_outcomes_once_per_chunk(self):
+        city = City.objects.create(name="Calgary")
+        WeatherData.objects.create(city=city, weather_data=TestSendWeatherEmail.weather)
+        subscriptions = [
+            Subscription.objects.create(
+                user=User.objects.create_user(username=f"metrics{i}", email=f"metrics{i}@example.com"),
+                city=city if i else City.objects.create(name="Nowhere"),
+            )
+            for i in range(3)
+        ]
+        sent = self.sample("weather_emails_total", {"outcome": "sent"})
+        skipped = self.sample("weather_emails_total", {"outcome": "skipped"})
+
+        send_weather_email_chunk([str(subscription.id) for subscription in subscriptions])
+
+        self.assertEqual(self.sample("weather_emails_total", {"outcome": "sent"}) - sent, 2)
+        self.assertEqual(self.sample("weather_emails_total", {"outcome": "skipped"}) - skipped, 1)
+
+    def test_fetch_records_api_latency(self):
+        cache.clear()
+        labels = {"provider": "openweathermap", "outcome": "success"}
+        before = self.sample("weather_api_request_duration_seconds_count", labels)
+        with LocalWeatherServer() as server:
+            fetcher = WeatherFetcher(base_url=server.url, api_key="test")
+            fetcher.fetch(1, 1)
+            fetcher.close()
+        self.assertEqual(self.sample("weather_api_request_duration_seconds_count", labels) - before, 1)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self, block=None):
+        super().__init__()
+        self.records = []
+        self.block = block
+
+    def emit(self, record):
+        if self.block:
+            self.block.wait()
+        self.records.append(record)
+
+
+class TestLogging(TestCase):
+    def record(self, msg="event %s", args=("x",), **extra):
+        record = logging.LogRecord("app.tasks", logging.INFO, __file__, 1, msg, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_sampling_keeps_unsampled_records_and_a_fraction_of_sampled_ones(self):
+        self.assertTrue(SamplingFilter(rate=0).filter(self.record()))
+        self.assertFalse(SamplingFilter(rate=0).filter(self.record(**SAMPLED)))
+        self.assertTrue(SamplingFilter(rate=1).filter(self.record(**SAMPLED)))
+
+    def test_records_carry_the_current_correlation_id(self):
+        token = correlation_id.set("task-1")
+        try:
+            record = self.record()
+            CorrelationIdFilter().filter(record)
+        finally:
+            correlation_id.reset(token)
+        self.assertEqual(json.loads(JsonFormatter().format(record))["correlation_id"], "task-1")
+
+    def test_requests_get_a_correlation_id(self):
+        response = self.client.get(reverse("metrics"), HTTP_X_REQUEST_ID="abc123")
+        self.assertEqual(response["X-Request-ID"], "abc123")
+        self.assertEqual(len(self.client.get(reverse("metrics"))["X-Request-ID"]), 32)
+
+    def test_queue_handler_writes_in_the_background(self):
+        target = RecordingHandler()
+        handler = QueueListenerHandler([target])
+        handler.handle(self.record())
+        handler.close()
+        self.assertEqual([record.getMessage() for record in target.records], ["event x"])
+        self.assertIsNone(target.records[0].args)
+
+    def test_queue_handler_drops_records_instead_of_blocking(self):
+        block = threading.Event()
+        target = RecordingHandler(block)
+        handler = QueueListenerHandler([target], queue_size=2)
+        for _ in range(10):
+            handler.handle(self.record())
+        block.set()
+        handler.close()
+        self.assertGreater(handler.dropped, 0)
+        self.assertEqual(len(target.records) + handler.dropped, 10)
+
+
+class TestQueryBudgets(TestCase):
+    # Budgets hold for ten subscriptions, so a per-row query fails them
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="budget", email="budget@example.com", password="Password123")
+        self.subscriptions = []
+        for i in range(10):
+            city = City.objects.create(name=f"Budget {i}")
+            WeatherData.objects.create(city=city, weather_data=TestSendWeatherEmail.weather)
+            self.subscriptions.append(Subscription.objects.create(user=self.user, city=city))
+
+    def test_budget_failure_lists_queries(self):
+        with self.assertRaisesMessage(AssertionError, "2 queries, budget 1"):
+            with query_budget(1):
+                list(City.objects.all())
+                list(Subscription.objects.all())
+
+    def test_main_page(self):
+        self.client.login(username="budget", password="Password123")
+        with query_budget(3):
+            response = self.client.get(reverse("main", kwargs={"username": "budget"}))
+        self.assertContains(response, "Budget 9")
+
+    def test_get_weather_view(self):
+        with query_budget(1):
+            response = self.client.get(reverse("get_weather", kwargs={"subscription_id": self.subscriptions[0].id}))
+        self.assertEqual(response.status_code, 200)
+
+    @patch("app.tasks.send_weather_email_chunk.delay")
+    def test_send_weather_email(self, delay):
+        Subscription.objects.update(next_message=timezone.now() - timedelta(minutes=1))
+        with self.captureOnCommitCallbacks(execute=True), query_budget(4):
+            send_weather_email()
+        chunk = delay.call_args.args[0]
+        self.assertEqual(len(chunk), 10)
+
+        with query_budget(1):
+            send_weather_email_chunk(chunk)
+        self.assertEqual(len(mail.outbox), 10)
+
+
+class TestProfiling(TestCase):
+    def busy(self, seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+
+    def test_profiler_collects_collapsed_stacks(self):
+        profiler = SamplingProfiler(interval=0.001).start()
+        self.busy(0.1)
+        profiler.stop()
+        self.assertTrue(any(stack.endswith("TestProfiling.busy") for stack in profiler.stacks))
+        line = profiler.collapsed().splitlines()[0]
+        self.assertRegex(line, r"^\S+(;\S+)* \d+$")
+
+    def test_middleware_profiles_requests_with_header(self):
+        def view(request):
+            self.busy(0.1)
+            return HttpResponse("ok")
+
+        middleware = ProfilerMiddleware(view)
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            PROFILE_DIR=directory, PROFILE_INTERVAL=0.001
+        ):
+            self.assertNotIn("X-Profile-Output", middleware(RequestFactory().get("/")))
+            response = middleware(RequestFactory().get("/weather", HTTP_X_PROFILE="1"))
+            output = Path(directory) / response["X-Profile-Output"]
+            self.assertIn("TestProfiling.busy", output.read_text())
+
+
+@skipUnless(connection.vendor == "sqlite", "SQLite locking")
+class TestDatabaseConcurrency(SimpleTestCase):
+    writers = 8
+    increments = 25
+
+    def test_parallel_writers_make_progress_without_lock_errors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # A file database; the in-memory test database doesn't lock like one
+            settings_dict = {**connection.settings_dict, "NAME": str(Path(directory) / "stress.sqlite3")}
+            DatabaseWrapper = type(connections["default"])
+            setup = DatabaseWrapper(settings_dict, "stress")
+            with setup.cursor() as cursor:
+                cursor.execute("CREATE TABLE counter (id INTEGER PRIMARY KEY, value INTEGER)")
+                cursor.execute("INSERT INTO counter VALUES (1, 0)")
+            setup.close()
+
+            errors = []
+
+            def writer():
+                connections["stress"] = DatabaseWrapper(settings_dict, "stress")
+                try:
+                    for _ in range(self.increments):
+                        # Read, then write, as the delivery claim does
+                        with transaction.atomic(using="stress"), connections["stress"].cursor() as cursor:
+                            cursor.execute("SELECT value FROM counter WHERE id = 1")
+                            value = cursor.fetchone()[0]
+                            time.sleep(0.001)
+                            cursor.execute("UPDATE counter SET value = %s WHERE id = 1", [value + 1])
+                except Exception as error:
+                    errors.append(error)
+                finally:
+                    connections["stress"].close()
+
+            threads = [threading.Thread(target=writer) for _ in range(self.writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            check = DatabaseWrapper(settings_dict, "stress")
+            with check.cursor() as cursor:
+                cursor.execute("SELECT value FROM counter WHERE id = 1")
+                value = cursor.fetchone()[0]
+            check.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(value, self.writers * self.increments)
+
+
+class TestSendWeatherEmail(TestCase):
+    weather = {
+        "main": {"temp": 12.5, "feels_like": 11.0, "humidity": 70, "pressure": 1012},
+        "wind": {"speed": 3.1, "deg": 240},
+        "clouds": {"all": 40},
+        "weather": [{"description": "light rain"}],
+    }
+
+    def setUp(self):
+        self.city = City.objects.create(name="Calgary")
+        WeatherData.objects.create(city=self.city, weather_data=self.weather)
+        self.subscriptions = [
+            Subscription.objects.create(
+                user=User.objects.create_user(
+                    username=f"user{i}", email=f"user{i}@example.com", password="Password123"
+                ),
+                city=self.city,
+            )
+            for i in range(3)
+        ]
+
+    def test_chunk_sends_emails(self):
+        send_weather_email_chunk([str(s.id) for s in self.subscriptions])
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertIn("Temperature: 12.5°C", mail.outbox[0].body)
+        self.assertIn("Precipitation: light rain", mail.outbox[0].body)
+
+    def test_chunk_query_count_does_not_grow_with_subscriptions(self):
+        with self.assertNumQueries(1):
+            send_weather_email_chunk([str(s.id) for s in self.subscriptions])
+
+    def set_next_message(self, subscription, next_message):
+        Subscription.objects.filter(id=subscription.id).update(next_message=next_message)
+
+    @override_settings(WEATHER_EMAIL_CHUNK_SIZE=2)
+    @patch("app.tasks.send_weather_email_chunk")
+    def test_due_subscriptions_are_claimed_once(self, chunk_task):
+        now = timezone.now()
+        due, overdue, later = self.subscriptions
+        self.set_next_message(due, now - timedelta(minutes=1))
+        self.set_next_message(overdue, now - timedelta(hours=20))
+        self.set_next_message(later, now + timedelta(minutes=5))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            send_weather_email()
+        with self.captureOnCommitCallbacks(execute=True):
+            send_weather_email()
+
+        chunk_task.delay.assert_called_once()
+        self.assertEqual(sorted(chunk_task.delay.call_args.args[0]), sorted([str(due.id), str(overdue.id)]))
+        due.refresh_from_db()
+        overdue.refresh_from_db()
+        top_of_hour = lambda moment: moment.replace(minute=0, second=0, microsecond=0)
+        self.assertEqual(
+            due.next_message,
+            top_of_hour(now - timedelta(minutes=1)) + timedelta(hours=6) + due.delivery_offset,
+        )
+        # Missed slots are skipped rather than replayed
+        self.assertEqual(
+            overdue.next_message,
+            top_of_hour(now - timedelta(hours=20)) + timedelta(hours=24) + overdue.delivery_offset,
+        )
+
+    def test_deliveries_are_spread_across_the_hour(self):
+        subscriptions = [
+            Subscription.objects.create(
+                user=User.objects.create_user(
+                    username=f"spread{i}", email=f"spread{i}@example.com", password="Password123"
+                ),
+                city=self.city,
+            )
+            for i in range(30)
+        ]
+        minutes = {subscription.next_message.minute for subscription in subscriptions}
+        self.assertGreater(len(minutes), 10)
+        for subscription in subscriptions:
+            self.assertEqual(subscription.next_message.minute, subscription.id.int % 60)
+            self.assertEqual(subscription.following_message(subscription.next_message).minute, subscription.id.int % 60)
+
+    @patch("app.tasks.send_weather_email_chunk")
+    def test_inactive_subscriptions_are_not_claimed(self, chunk_task):
+        Subscription.objects.update(next_message=timezone.now() - timedelta(minutes=1), is_active=False)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            send_weather_email()
+
+        chunk_task.delay.assert_not_called()
+
+
+class FlakyEmailBackend(BaseEmailBackend):
+    opened = 0
+
+    def open(self):
+        FlakyEmailBackend.opened += 1
+        self.disconnected = FlakyEmailBackend.opened == 1
+
+    def send_messages(self, email_messages):
+        if self.disconnected:
+            self.disconnected = False
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        for message in email_messages:
+            if message.to == ["rejected@example.com"]:
+                raise smtplib.SMTPRecipientsRefused({message.to[0]: (550, b"No such user")})
+        return len(email_messages)
+
+
+class TestSMTPConnectionPool(TestCase):
+    def build_messages(self, count):
+        return [
+            EmailMessage("Weather", "Sunny", "from@example.com", [f"user{i}@example.com"])
+            for i in range(count)
+        ]
+
+    def test_batches_reuse_pooled_connections(self):
+        with LocalSMTPServer() as server:
+            pool = SMTPConnectionPool(
+                size=2,
+                batch_size=5,
+                backend="django.core.mail.backends.smtp.EmailBackend",
+                host="127.0.0.1",
+                port=server.port,
+                use_ssl=False,
+                use_tls=False,
+                username="",
+                password="",
+            )
+            report = pool.send_messages(self.build_messages(20))
+            pool.close()
+
+        self.assertEqual(len(report.sent), 20)
+        self.assertEqual(len(server.messages), 20)
+        self.assertLessEqual(server.connections, 2)
+        self.assertGreater(report.throughput, 0)
+
+    def test_reconnects_and_reports_per_message_failures(self):
+        FlakyEmailBackend.opened = 0
+        messages = self.build_messages(2)
+        messages.append(EmailMessage("Weather", "Sunny", "from@example.com", ["rejected@example.com"]))
+
+        pool = SMTPConnectionPool(size=1, batch_size=10, backend="app.tests.FlakyEmailBackend")
+        report = pool.send_messages(messages)
+
+        self.assertEqual(FlakyEmailBackend.opened, 2)
+        self.assertEqual(len(report.sent), 2)
+        self.assertEqual(report.failed[0][0].to, ["rejected@example.com"])
+        self.assertIsInstance(report.failed[0][1], smtplib.SMTPRecipientsRefused)
+
+    def test_refused_connect_fails_messages_without_using_up_the_pool(self):
+        with LocalSMTPServer() as server:
+            port = server.port
+        pool = SMTPConnectionPool(
+            size=1,
+            batch_size=10,
+            backend="django.core.mail.backends.smtp.EmailBackend",
+            host="127.0.0.1",
+            port=port,
+            use_ssl=False,
+            use_tls=False,
+            username="",
+            password="",
+        )
+        for _ in range(3):
+            report = pool.send_messages(self.build_messages(2))
+            self.assertEqual(len(report.failed), 2)
+            self.assertIsInstance(report.failed[0][1], ConnectionRefusedError)
+        self.assertEqual(pool._created, 0)
+
+
+class TestMessageCache(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(name="Calgary")
+        self.weather = WeatherData.objects.create(
+            city=self.city, weather_data=TestSendWeatherEmail.weather
+        )
+        self.cache = MessageCache(max_size=2)
+
+    def test_mask_selects_lines_in_fixed_order(self):
+        subscription = Subscription(temperature=True, wind=True, precipitation=False, cloudiness=False)
+        message = self.cache.render(self.city, self.weather, field_mask(subscription))
+        self.assertEqual(
+            message,
+            "Weather forecast for Calgary:\nTemperature: 12.5°C\nWind: 3.1 m/s at 240°\n",
+        )
+
+    def test_same_city_snapshot_and_mask_render_once(self):
+        mask = field_mask(Subscription())
+        first = self.cache.render(self.city, self.weather, mask)
+        second = self.cache.render(self.city, self.weather, mask)
+        self.assertIs(first, second)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        self.weather.update_data({**TestSendWeatherEmail.weather, "main": {"temp": 1}})
+        self.assertIn("Temperature: 1°C", self.cache.render(self.city, self.weather, 1))
+        self.assertEqual(self.cache.misses, 2)
+
+
+class TestWeatherFetcher(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_fetch_many_reuses_connections(self):
+        locations = {i: (50.0 + i, -114.0) for i in range(20)}
+        with LocalWeatherServer() as server:
+            fetcher = WeatherFetcher(base_url=server.url, api_key="test", concurrency=4)
+            results = fetcher.fetch_many(locations)
+            fetcher.close()
+
+        self.assertEqual(set(results), set(locations))
+        self.assertEqual(results[3]["coord"]["lat"], 53.0)
+        self.assertEqual(len(server.requests), 20)
+        self.assertLessEqual(server.connections, 4)
+
+    def test_fetch_reports_errors_per_location(self):
+        def responder(query):
+            if query["lat"] == "1":
+                return 500, {"message": "boom"}
+            return openweathermap_responder(query)
+
+        with LocalWeatherServer(responder) as server:
+            fetcher = WeatherFetcher(base_url=server.url, api_key="test", concurrency=2)
+            results = fetcher.fetch_many({"bad": (1, 1), "good": (2, 2)})
+            fetcher.close()
+
+        self.assertIn("error", results["bad"])
+        self.assertEqual(results["good"]["main"]["temp"], 10.0)
+
+    def test_refresh_chunk_fetches_all_cities_in_one_batch(self):
+        stale = City.objects.create(name="Calgary", latitude=51.0, longitude=-114.0)
+        weather = WeatherData.objects.create(city=stale, weather_data={"temp": 1})
+        missing = City.objects.create(name="Edmonton", latitude=53.5, longitude=-113.5)
+
+        with LocalWeatherServer() as server:
+            provider = OpenWeatherMapProvider(WeatherFetcher(base_url=server.url))
+            with patch("app.tasks.get_provider", return_value=provider):
+                totals = refresh_weather_chunk([stale.id, missing.id])
+
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(totals, {"updated": 1, "created": 1, "failed": 0, "fetches": 2})
+        weather.refresh_from_db()
+        self.assertEqual(weather.weather_data["coord"]["lat"], 51.0)
+        self.assertEqual(missing.data.get().weather_data["coord"]["lat"], 53.5)
+
+
+class TestApiGuard(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_token_bucket_allows_burst_then_waits(self):
+        bucket = TokenBucket("test", rate=1, capacity=3)
+        self.assertEqual([bucket.try_acquire() for _ in range(3)], [0, 0, 0])
+        self.assertGreater(bucket.try_acquire(), 0)
+        self.assertFalse(bucket.acquire(timeout=0))
+
+    def test_quota_stops_after_daily_limit(self):
+        quota = Quota("test", daily=2, monthly=0)
+        self.assertEqual([quota.consume() for _ in range(3)], [True, True, False])
+        self.assertEqual(quota.usage()["daily"], 3)
+
+    @override_settings(WEATHER_API_FAILURE_THRESHOLD=2)
+    def test_circuit_opens_after_repeated_failures(self):
+        with LocalWeatherServer(lambda query: (500, {"message": "boom"})) as server:
+            fetcher = WeatherFetcher(base_url=server.url, api_key="test", guard=ApiGuard("test"))
+            results = [fetcher.fetch(1, 1) for _ in range(4)]
+            fetcher.close()
+
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(results[3], {"error": "Weather API paused after repeated failures"})
+
+    @override_settings(WEATHER_API_DAILY_QUOTA=1)
+    def test_fetcher_respects_quota(self):
+        with LocalWeatherServer() as server:
+            fetcher = WeatherFetcher(base_url=server.url, api_key="test")
+            results = fetcher.fetch_many({"first": (1, 1), "second": (2, 2)})
+            fetcher.close()
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertIn({"error": "Weather API quota exhausted"}, results.values())
+
+    @override_settings(WEATHER_API_BURST=1, WEATHER_API_RATE_PER_SECOND=0.5, WEATHER_API_RATE_WAIT=30)
+    def test_request_path_does_not_wait_for_a_token(self):
+        city = City.objects.create(name="Calgary", latitude=51.04, longitude=-114.07)
+        with LocalWeatherServer() as server:
+            fetcher = WeatherFetcher(base_url=server.url, api_key="test")
+            fetcher.guard.bucket.try_acquire()
+            with patch("app.providers.get_provider", return_value=OpenWeatherMapProvider(fetcher)):
+                started = time.monotonic()
+                entry = get_city_weather(city)
+            fetcher.close()
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(entry["data"], {"error": "Weather API rate limit reached"})
+        self.assertEqual(server.requests, [])
+
+
+class TestOpenMeteoProvider(TestCase):
+    def test_fetch_many_requests_all_locations_in_one_call(self):
+        locations = {"calgary": (51.05, -114.07), "edmonton": (53.55, -113.49), "banff": (51.18, -115.57)}
+        with LocalWeatherServer(open_meteo_responder) as server:
+            results = OpenMeteoProvider(url=server.url).fetch_many(locations)
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(server.requests[0]["format"], "flatbuffers")
+        # OpenWeatherMap's main.pressure is sea-level pressure, not surface pressure
+        self.assertIn("pressure_msl", server.requests[0]["current"].split(","))
+        self.assertAlmostEqual(results["edmonton"]["coord"]["lat"], 53.55, places=4)
+        self.assertEqual(
+            results["banff"]["main"],
+            {"temp": 10.0, "feels_like": 9.0, "humidity": 60, "pressure": 1015},
+        )
+        self.assertEqual(results["calgary"]["wind"], {"speed": 2.5, "deg": 180, "gust": 5.0})
+        self.assertEqual(results["calgary"]["weather"][0]["description"], "partly cloudy")
+
+    def test_failed_batch_reports_error_for_each_location(self):
+        with LocalWeatherServer(lambda query: (500, {"reason": "down"})) as server:
+            results = OpenMeteoProvider(url=server.url).fetch_many({"a": (1, 1), "b": (2, 2)})
+
+        self.assertIn("error", results["a"])
+        self.assertIn("error", results["b"])
+
+
+class TestSpatialIndex(TestCase):
+    def test_kdtree_matches_brute_force_radius_search(self):
+        points = [(49 + (i % 7) * 0.05, -114 + (i // 7) * 0.05, i) for i in range(49)]
+        tree = KDTree(points)
+        for latitude, longitude in [(49.1, -113.9), (49.3, -113.7), (48.0, -114.0)]:
+            expected = {
+                item for lat, lon, item in points if haversine_km(latitude, longitude, lat, lon) <= 8
+            }
+            self.assertEqual(set(tree.query_radius(latitude, longitude, 8)), expected)
+
+    def test_nearby_cities_share_one_fetch(self):
+        new_york = City.objects.create(name="New York", latitude=40.7128, longitude=-74.0060)
+        nyc = City.objects.create(name="NYC", latitude=40.7306, longitude=-73.9866)
+        boston = City.objects.create(name="Boston", latitude=42.3601, longitude=-71.0589)
+
+        clusters = CityIndex([boston, nyc, new_york]).clusters(5)
+        self.assertEqual(clusters, {new_york: [new_york, nyc], boston: [boston]})
+
+        with LocalWeatherServer() as server:
+            provider = OpenWeatherMapProvider(WeatherFetcher(base_url=server.url))
+            with patch("app.tasks.get_provider", return_value=provider):
+                refresh_weather_chunk([new_york.id, nyc.id, boston.id])
+
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(nyc.data.get().weather_data, new_york.data.get().weather_data)
+
+    def test_nearby_search_covers_the_radius_away_from_the_equator(self):
+        for latitude in (0, 45, 60, 75, 85):
+            for longitude in (-180.0, -179.99, -179.9, -0.01, 10.0, 123.456, 179.99, 180.0):
+                for bearing in range(0, 360, 15):
+                    # A point 4.9 km away, in a 5 km radius
+                    d_lat = 4.9 / KM_PER_DEGREE * math.cos(math.radians(bearing))
+                    d_lon = 4.9 / KM_PER_DEGREE * math.sin(math.radians(bearing)) / math.cos(
+                        math.radians(latitude + d_lat)
+                    )
+                    # Geocoders report longitudes in [-180, 180), wrapping at the antimeridian
+                    other = (longitude + d_lon + 180) % 360 - 180
+                    self.assertIn(
+                        grid_cell(latitude + d_lat, other, 5),
+                        neighbor_cells(latitude, longitude, 5),
+                        (latitude, longitude, bearing),
+                    )
+
+    def test_find_nearby_at_high_latitude(self):
+        city = City(name="Oslo")
+        city.set_coordinates((60.0, 10.0))
+        city.save()
+        self.assertEqual(City.find_nearby(60.0, 10.0 + 4.9 / (KM_PER_DEGREE * math.cos(math.radians(60))), 5), city)
+
+    def test_find_nearby_across_the_antimeridian(self):
+        city = City(name="Taveuni")
+        city.set_coordinates((-16.8, 179.99))
+        city.save()
+        self.assertEqual(City.find_nearby(-16.8, -179.99, 5), city)
+
+    @patch("app.geocoding.Nominatim")
+    def test_new_spelling_of_tracked_city_reuses_it(self, nominatim):
+        form = CreateSubscriptionForm({"city": "New York", "period": 6})
+        self.assertTrue(form.is_valid())
+        new_york = form.cleaned_data["city"]
+
+        form = CreateSubscriptionForm({"city": "NYC", "period": 6})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data["city"], new_york)
+        self.assertEqual(City.objects.count(), 1)
+        nominatim.assert_not_called()
+
+
+class TestGeocoding(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    @patch("app.geocoding.Nominatim")
+    def test_gazetteer_resolves_known_cities_offline(self, nominatim):
+        self.assertEqual(geocode("  new   YORK "), (40.7128, -74.006))
+        self.assertEqual(geocode("Zürich"), (47.3769, 8.5417))
+        nominatim.assert_not_called()
+
+    @patch("app.geocoding.Nominatim")
+    def test_remote_lookup_runs_only_on_cache_miss(self, nominatim):
+        nominatim.return_value.geocode.return_value.latitude = 49.69
+        nominatim.return_value.geocode.return_value.longitude = -112.84
+
+        self.assertEqual(geocode("Lethbridge"), (49.69, -112.84))
+        self.assertEqual(geocode("lethbridge"), (49.69, -112.84))
+        cache.clear()
+        self.assertEqual(geocode("LETHBRIDGE"), (49.69, -112.84))
+
+        self.assertEqual(nominatim.return_value.geocode.call_count, 1)
+        self.assertTrue(GeocodedName.objects.filter(name="lethbridge").exists())
+
+    def test_city_not_found_by_geocoder_is_a_form_error(self):
+        City.objects.create(name="Atlantis", status=City.Status.NOT_FOUND)
+        form = CreateSubscriptionForm({"city": "atlantis", "period": 6})
+        self.assertFalse(form.is_valid())
+        self.assertIn("city", form.errors)
+
+
+class TestDeferredCityResolution(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="Password123")
+        self.client.login(username="testuser", password="Password123")
+        self.main_url = reverse("main", kwargs={"username": "testuser"})
+
+    @patch("app.views.resolve_city")
+    @patch("app.geocoding.Nominatim")
+    def test_unknown_city_is_saved_pending_and_resolved_after_commit(self, nominatim, task):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                self.main_url, {"create_subscription": "true", "city": "Lethbridge", "period": 6}
+            )
+
+        self.assertRedirects(response, self.main_url)
+        nominatim.assert_not_called()
+        city = City.objects.get(name="Lethbridge")
+        self.assertTrue(city.is_pending)
+        task.delay.assert_called_once_with(city.id)
+
+        status = self.client.get(reverse("city_status", kwargs={"city_id": city.id})).json()
+        self.assertEqual(status["status"], "pending")
+        self.assertContains(self.client.get(self.main_url), "Locating...")
+
+    @patch("app.tasks.get_provider")
+    @patch("app.geocoding.Nominatim")
+    def test_resolve_city_sets_coordinates_and_seeds_weather(self, nominatim, provider):
+        nominatim.return_value.geocode.return_value.latitude = 49.69
+        nominatim.return_value.geocode.return_value.longitude = -112.84
+        provider.return_value.fetch.return_value = {"main": {"temp": 3}}
+        city = City.objects.create(name="Lethbridge", status=City.Status.PENDING)
+
+        resolve_city(city.id)
+
+        city.refresh_from_db()
+        self.assertEqual(city.status, City.Status.RESOLVED)
+        self.assertEqual((city.latitude, city.longitude), (49.69, -112.84))
+        self.assertEqual(city.data.get().weather_data, {"main": {"temp": 3}})
+
+    @patch("app.tasks.get_provider")
+    @patch("app.geocoding.Nominatim")
+    def test_subscription_created_during_geocoding_is_counted(self, nominatim, provider):
+        provider.return_value.fetch.return_value = {"main": {"temp": 3}}
+        city = City.objects.create(name="Lethbridge", status=City.Status.PENDING)
+        Subscription.objects.create(user=self.user, city=city)
+        other = User.objects.create_user(username="other", password="Password123")
+
+        def geocode_slowly(name, **kwargs):
+            Subscription.objects.create(user=other, city=city)
+            return type("Location", (), {"latitude": 49.69, "longitude": -112.84})
+
+        nominatim.return_value.geocode.side_effect = geocode_slowly
+        resolve_city(city.id)
+
+        city.refresh_from_db()
+        self.assertEqual(city.status, City.Status.RESOLVED)
+        self.assertEqual(city.subscribers_count, 2)
+        self.assertIsNotNone(city.current_weather)
+
+    @patch("app.geocoding.Nominatim")
+    def test_resolve_city_merges_into_nearby_city(self, nominatim):
+        nominatim.return_value.geocode.return_value.latitude = 51.05
+        nominatim.return_value.geocode.return_value.longitude = -114.07
+        calgary = City(name="Calgary")
+        calgary.set_coordinates((51.0447, -114.0719))
+        calgary.save()
+        pending = City.objects.create(name="YYC", status=City.Status.PENDING)
+        subscription = Subscription.objects.create(user=self.user, city=pending)
+
+        resolve_city(pending.id)
+
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.city, calgary)
+        self.assertFalse(City.objects.filter(id=pending.id).exists())
+
+    @patch("app.geocoding.Nominatim")
+    def test_unfound_city_drops_its_subscriptions(self, nominatim):
+        nominatim.return_value.geocode.return_value = None
+        pending = City.objects.create(name="Atlantis", status=City.Status.PENDING)
+        Subscription.objects.create(user=self.user, city=pending)
+
+        resolve_city(pending.id)
+
+        pending.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual(pending.status, City.Status.NOT_FOUND)
+        self.assertFalse(Subscription.objects.filter(city=pending).exists())
+        self.assertEqual(self.user.subscriptions_count, 0)
+
+
+class TestWeatherCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.city = City.objects.create(name="Calgary", latitude=51.04, longitude=-114.07)
+
+    @patch("app.providers.get_provider")
+    def test_stale_data_is_served_and_refreshed_once(self, provider):
+        weather = WeatherData.objects.create(city=self.city, weather_data={"temp": 25})
+        weather.updated_at = timezone.now() - timedelta(hours=2)
+        weather.save()
+
+        with patch("app.tasks.refresh_city_weather") as task:
+            with self.captureOnCommitCallbacks(execute=True):
+                for _ in range(3):
+                    self.assertEqual(get_city_weather(self.city)["data"], {"temp": 25})
+
+        task.delay.assert_called_once_with(self.city.id)
+        provider.assert_not_called()
+
+    @patch("app.providers.get_provider")
+    def test_miss_is_fetched_by_lock_holder(self, provider):
+        provider.return_value.fetch.return_value = {"temp": 7}
+
+        self.assertEqual(get_city_weather(self.city)["data"], {"temp": 7})
+        self.assertEqual(self.city.data.get().weather_data, {"temp": 7})
+        self.assertTrue(acquire_refresh_lock(self.city.id))
+
+    @patch("app.providers.get_provider")
+    def test_miss_waits_for_fetch_in_flight_elsewhere(self, provider):
+        self.assertTrue(acquire_refresh_lock(self.city.id))
+        other_worker = threading.Timer(
+            0.1,
+            cache.set,
+            args=(f"weather:{self.city.id}", {"data": {"temp": 7}, "updated_at": timezone.now()}),
+        )
+        other_worker.start()
+
+        self.assertEqual(get_city_weather(self.city)["data"], {"temp": 7})
+        provider.assert_not_called()
+
+
+class TestWeatherEndpointConditionalGet(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="testuser", password="Password123")
+        city = City.objects.create(name="Calgary", latitude=51.04, longitude=-114.07)
+        subscription = Subscription.objects.create(user=user, city=city)
+        WeatherData.objects.create(city=city, weather_data=TestSendWeatherEmail.weather)
+        self.url = reverse("get_weather", kwargs={"subscription_id": subscription.id})
+
+    def test_unchanged_weather_returns_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header("Last-Modified"))
+        self.assertIn("private", response["Cache-Control"])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_fields_parameter_projects_payload(self):
+        response = self.client.get(self.url, {"fields": "main.temp,wind,missing.key"})
+        self.assertEqual(response.json(), {"main": {"temp": 12.5}, "wind": {"speed": 3.1, "deg": 240}})
+
+        full = self.client.get(self.url)
+        self.assertNotEqual(response["ETag"], full["ETag"])
+
+    def test_missing_nested_fields_leave_no_empty_parents(self):
+        response = self.client.get(self.url, {"fields": "main.x.y,wind.deg.z,clouds.missing"})
+        self.assertEqual(response.json(), {})
+
+    def test_cached_weather_is_served_with_one_query(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(1):
+            self.client.get(self.url)
+
+
+class TestWeatherSnapshots(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.city = City.objects.create(name="Calgary", latitude=51.04, longitude=-114.07)
+
+    def test_latest_snapshot_is_read_through_pointer(self):
+        old = WeatherData.objects.create(city=self.city, weather_data={"temp": 1})
+        new = WeatherData.objects.create(city=self.city, weather_data={"temp": 2})
+        subscription = Subscription.objects.create(
+            user=User.objects.create_user(username="testuser", password="Password123"), city=self.city
+        )
+        old.update_data({"temp": 3})
+
+        subscription = Subscription.objects.select_related("city__current_weather").get(id=subscription.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(subscription.get_weather_data(), {"temp": 2})
+        self.assertEqual(self.city.history.count(), 3)
+        self.assertEqual(new.city.history.latest("observed_at").weather_data, {"temp": 3})
+
+    def test_each_snapshot_is_recorded_once(self):
+        weather = WeatherData.objects.create(city=self.city, weather_data=TestSendWeatherEmail.weather)
+        weather.update_data(TestSendWeatherEmail.weather)
+        weather.save()
+
+        self.assertEqual(self.city.history.count(), 2)
+        self.assertEqual(sum(self.city.series.values_list("count", flat=True)), 2)
+
+    @patch("app.tasks.get_provider")
+    def test_refresh_chunk_records_history_in_one_batch(self, provider):
+        def refresh(count):
+            cities = [
+                City.objects.create(name=f"City {count}-{i}", latitude=10 * i, longitude=count)
+                for i in range(count)
+            ]
+            provider.return_value.fetch_many.return_value = {
+                city.id: TestSendWeatherEmail.weather for city in cities
+            }
+            with CaptureQueriesContext(connection) as queries:
+                refresh_weather_chunk([city.id for city in cities])
+            return cities, len(queries)
+
+        _, one = refresh(1)
+        cities, four = refresh(4)
+
+        # Per city only the snapshot insert and the current_weather pointer
+        self.assertEqual(four - one, 3 * 2)
+        for city in cities:
+            self.assertEqual(city.history.count(), 1)
+            self.assertEqual(city.series.get().count, 1)
+
+    def test_sweeper_drops_expired_partitions(self):
+        now = timezone.now()
+        for days in (1, 40, 41):
+            WeatherHistory.objects.create(
+                city=self.city, observed_at=now - timedelta(days=days), weather_data={"temp": days}
+            )
+        superseded = WeatherData.objects.create(city=self.city, weather_data={"temp": 0})
+        WeatherData.objects.filter(id=superseded.id).update(updated_at=now - timedelta(days=40))
+        current = WeatherData.objects.create(city=self.city, weather_data={"temp": 5})
+
+        sweep_weather_history()
+
+        self.assertEqual(
+            sorted(WeatherHistory.objects.values_list("weather_data__temp", flat=True)), [0, 1, 5]
+        )
+        self.assertEqual(list(WeatherData.objects.all()), [current])
+
+
+class TestHistoryStore(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.city = City.objects.create(name="Calgary", latitude=51.04, longitude=-114.07)
+        self.start = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=2)
+        weather = WeatherData.objects.create(city=self.city, weather_data=TestSendWeatherEmail.weather)
+        for hour in range(48):
+            weather.weather_data = {
+                "main": {"temp": float(hour % 24), "humidity": 50},
+                "wind": {"speed": 2.0, "deg": 90},
+            }
+            weather.updated_at = self.start + timedelta(hours=hour)
+            weather.save()
+            weather.record_observation()
+
+    def test_observations_are_stored_one_row_per_day(self):
+        self.assertEqual(
+            list(self.city.series.order_by("day").values_list("count", flat=True)), [24, 24, 1]
+        )
+
+    def test_range_query_and_downsampling(self):
+        observations = load_range(self.city.id, self.start + timedelta(hours=20), self.start + timedelta(hours=27))
+        self.assertEqual(list(observations["temp"]), [20, 21, 22, 23, 0, 1, 2, 3])
+        self.assertTrue(np.isnan(observations["clouds"]).all())
+
+        six_hourly = downsample(observations, 6 * 3600)
+        self.assertEqual(list(six_hourly["temp"]), [21.5, 1.5])
+        self.assertEqual(list(six_hourly["humidity"]), [50, 50])
+
+    def test_daily_aggregates(self):
+        aggregates = daily_aggregates(self.city.id, self.start.date(), self.start.date() + timedelta(days=1))
+        self.assertEqual(
+            [(day["min"], day["max"], day["mean"]) for day in aggregates], [(0, 23, 11.5)] * 2
+        )
+
+
+class TestWeatherRefreshPlanner(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="planner", email="planner@example.com", password="Password123")
+
+    def city(self, name, weather_age=None, due_in=None, is_active=True):
+        city = City.objects.create(name=name, latitude=len(name), longitude=1)
+        if weather_age is not None:
+            weather = WeatherData.objects.create(city=city, weather_data={"temp": 1})
+            WeatherData.objects.filter(id=weather.id).update(updated_at=timezone.now() - weather_age)
+        if due_in is not None:
+            subscription = Subscription.objects.create(user=self.user, city=city, is_active=is_active)
+            # save() moves past deliveries forward, so overdue ones are set directly
+            Subscription.objects.filter(id=subscription.id).update(next_message=timezone.now() + due_in)
+        return city
+
+    @override_settings(WEATHER_REFRESH_CHUNK_SIZE=2)
+    @patch("app.tasks.chord")
+    def test_outdated_cities_are_dispatched_in_chunks(self, chord):
+        self.city("Fresh", weather_age=timedelta(minutes=1), due_in=timedelta(minutes=30))
+        stale = self.city("Stale", weather_age=timedelta(hours=2), due_in=timedelta(minutes=30))
+        missing = [self.city(f"City {i}", due_in=timedelta(minutes=10)) for i in range(3)]
+        City.objects.create(name="Pending", status=City.Status.PENDING)
+
+        with self.assertNumQueries(1):
+            update_weather_data_async()
+
+        subtasks = chord.call_args.args[0]
+        self.assertEqual(
+            sorted(city_id for subtask in subtasks for city_id in subtask.args[0]),
+            sorted([stale.id] + [city.id for city in missing]),
+        )
+        self.assertEqual([len(subtask.args[0]) for subtask in subtasks], [2, 2])
+        chord.return_value.assert_called_once()
+
+    @patch("app.tasks.chord")
+    def test_only_cities_with_upcoming_deliveries_are_prefetched(self, chord):
+        due = self.city("Due", weather_age=timedelta(hours=2), due_in=timedelta(minutes=20))
+        overdue = self.city("Overdue", weather_age=timedelta(hours=2), due_in=-timedelta(minutes=5))
+        self.city("Later", weather_age=timedelta(hours=2), due_in=timedelta(hours=5))
+        self.city("Paused", weather_age=timedelta(hours=2), due_in=timedelta(minutes=20), is_active=False)
+        self.city("Idle", weather_age=timedelta(hours=2))
+        idle_stale = self.city("Idle stale", weather_age=timedelta(days=2))
+
+        update_weather_data_async()
+
+        city_ids = [city_id for subtask in chord.call_args.args[0] for city_id in subtask.args[0]]
+        self.assertEqual(sorted(city_ids), sorted([due.id, overdue.id, idle_stale.id]))
 
+    def test_summary_adds_chunk_totals(self):
+        totals = summarize_weather_refresh(
+            [{"updated": 1, "created": 2, "failed": 0, "fetches": 3}, {"updated": 4, "created": 0, "failed": 1, "fetches": 4}]
+        )
+        self.assertEqual(totals, {"updated": 5, "created": 2, "failed": 1, "fetches": 7})
@@ -19,6 +19,8 @@ urlpatterns = [
         delete_subscription_view,
         name="delete_subscription",
     ),
+    path("city/<int:city_id>/status", city_status_view, name="city_status"),
+    path("metrics", metrics_view, name="metrics"),
     path("login", login_view, name="login"),
     path("register", register_view, name="register"),
     path("logout", logout_view, name="logout"),
@@ -1,5 +1,3 @@
-import json
-import urllib.request
 import environ
 
 env = environ.Env()
@@ -8,11 +6,37 @@ key = env("WEATHER_API_KEY")
 
 
 def get_weather_data_from_api(latitude, longitude):
-    weather_request = f"https://api.openweathermap.org/data/2.5/weather?lat={latitude}&lon={longitude}&appid={key}&units=metric"
-    try:
-        weather = urllib.request.urlopen(weather_request)
-        data = json.loads(weather.read())
-        if isinstance(data, dict):
-            return data
-    except Exception as e:
-        return {"error": f"Error fetching weather data: {e}"}
+    from .providers import get_provider
+
+    return get_provider().fetch(latitude, longitude)
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def project_fields(data, fields):
+    # Keeps only the dotted paths in fields, e.g. ["main.temp", "wind"]
+    projected = {}
+    for field in fields:
+        source = data
+        *parents, leaf = field.strip().split(".")
+        for name in parents:
+            if not isinstance(source, dict) or name not in source:
+                break
+            source = source[name]
+        else:
+            if isinstance(source, dict) and leaf in source:
+                # Parents are only created once the whole path is known to exist
+                target = projected
+                for name in parents:
+                    target = target.setdefault(name, {})
+                target[leaf] = source[leaf]
+    return projected
@@ -1,17 +1,25 @@
-from datetime import timedelta
+import hashlib
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from prometheus_client import CONTENT_TYPE_LATEST
 from django.shortcuts import render, get_object_or_404
 from django.contrib import auth
 from django.shortcuts import redirect, HttpResponseRedirect
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 from django.views.generic import ListView
 
-from .utils import get_weather_data_from_api
-from .models import Subscription, CustomUser, WeatherData
+from . import metrics
+from .page_cache import csrf_digest, invalidate_main_page, main_page_version
+from .tasks import resolve_city
+from .utils import project_fields
+from .weather_cache import get_city_weather
+from .models import Subscription, CustomUser, City
 from .forms import (
     UserRegistrationForm,
     UserAuthenticationForm,
@@ -35,32 +43,42 @@ class MainPageView(ListView):
 
     def get_user(self):
         username = self.kwargs.get("username")
+        if self.request.user.is_authenticated and self.request.user.username == username:
+            return self.request.user
         return get_object_or_404(CustomUser, username=username)
 
     def get_queryset(self):
         self.user = self.get_user()
-        return Subscription.objects.filter(user=self.user).order_by("city")
+        # Only evaluated when the cached fragment has to be rendered again
+        return Subscription.objects.filter(user=self.user).select_related("city").order_by("city")
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["form"] = CreateSubscriptionForm()
+        context.setdefault("form", CreateSubscriptionForm())
         context["user"] = self.user
+        context["page_version"] = main_page_version(self.user.pk)
+        context["csrf_digest"] = csrf_digest(self.request)
+        context["page_cache_timeout"] = settings.MAIN_PAGE_CACHE_TIMEOUT
         return context
 
     def post(self, request, *args, **kwargs):
         self.user = self.get_user()
+        form = CreateSubscriptionForm()
 
         if "create_subscription" in request.POST:
-            form = CreateSubscriptionForm(request.POST)
-            if self.user.check_subscriptions_amount():
-                if form.is_valid():
-                    with transaction.atomic():
-                        subscription = form.save(commit=False)
-                        subscription.user = self.user
-                        subscription.save()
-                        return redirect(
-                            reverse("main", kwargs={"username": self.user.username})
-                        )
+            form = CreateSubscriptionForm(request.POST, user=self.user)
+            if form.is_valid():
+                with transaction.atomic():
+                    subscription = form.save(commit=False)
+                    subscription.user = self.user
+                    subscription.save()
+                    invalidate_main_page(self.user.pk)
+                    if subscription.city.is_pending:
+                        city_id = subscription.city.id
+                        transaction.on_commit(lambda: resolve_city.delay(city_id))
+                    return redirect(
+                        reverse("main", kwargs={"username": self.user.username})
+                    )
 
         elif "change_period" in request.POST:
             subscription_id = request.POST.get("subscription_id")
@@ -70,12 +88,13 @@ class MainPageView(ListView):
             change_period_form = ChangePeriodForm(request.POST, instance=subscription)
             if change_period_form.is_valid():
                 change_period_form.save()
+                invalidate_main_page(self.user.pk)
                 return redirect(
                     reverse("main", kwargs={"username": self.user.username})
                 )
 
         self.object_list = self.get_queryset()
-        context = self.get_context_data()
+        context = self.get_context_data(form=form)
         return self.render_to_response(context)
 
 
@@ -122,6 +141,7 @@ def change_attr_view(request, subscription_id, attr):
             current_value = getattr(subscription, attr)
             setattr(subscription, attr, not current_value)
             subscription.save()
+            invalidate_main_page(user.pk)
             return redirect(
                 reverse("main", kwargs={"username": user.username}), status_code=200
             )
@@ -138,6 +158,7 @@ def delete_subscription_view(request, subscription_id):
 
     if user.id == subscription.user.id:
         subscription.delete()
+        invalidate_main_page(user.pk)
         return redirect(
             reverse("main", kwargs={"username": user.username}), status_code=200
         )
@@ -145,33 +166,85 @@ def delete_subscription_view(request, subscription_id):
         JsonResponse({"message": "Cheater detected"}, status=401)
 
 
+def _weather_lookup(request, subscription_id):
+    # Shared by the conditional GET callbacks and the view, so a request
+    # resolves the city and its weather only once
+    if not hasattr(request, "weather_lookup"):
+        city = (
+            City.objects.select_related("current_weather")
+            .filter(subscriptions__id=subscription_id)
+            .first()
+        )
+        entry = None
+        if city is not None and not city.is_pending:
+            entry = get_city_weather(city)
+        request.weather_lookup = (city, entry)
+    return request.weather_lookup
+
+
+def _weather_is_servable(entry):
+    return entry is not None and "error" not in entry["data"]
+
+
+def _weather_etag(request, subscription_id):
+    city, entry = _weather_lookup(request, subscription_id)
+    if not _weather_is_servable(entry):
+        return None
+    fields = request.GET.get("fields", "")
+    return hashlib.md5(
+        f"{city.id}:{entry['updated_at'].isoformat()}:{fields}".encode()
+    ).hexdigest()
+
+
+def _weather_last_modified(request, subscription_id):
+    city, entry = _weather_lookup(request, subscription_id)
+    if not _weather_is_servable(entry):
+        return None
+    return entry["updated_at"]
+
+
+@condition(etag_func=_weather_etag, last_modified_func=_weather_last_modified)
 def get_weather_view(request, subscription_id):
-    try:
-        subscription = Subscription.objects.get(id=subscription_id)
-    except Subscription.DoesNotExist:
+    city, entry = _weather_lookup(request, subscription_id)
+    if city is None:
         return JsonResponse({"message": "Subscription not found"}, status=404)
+    if city.is_pending:
+        return JsonResponse({"message": "City location is still being resolved"}, status=202)
+
+    # Stale data is served as is while a single background task refreshes it,
+    # because of payments for weather data service
+    if entry is None:
+        return JsonResponse({"message": "Weather data is being updated, try again later"}, status=503)
+
+    data = entry["data"]
+    if "error" in data:
+        return JsonResponse(
+            {"message": f"Error fetching weather data: {data['error']}"}, status=500
+        )
 
-    latitude = subscription.city.latitude
-    longitude = subscription.city.longitude
-    city = subscription.city
-    weather_data_object, created = WeatherData.objects.get_or_create(city=city)
-    data = weather_data_object.weather_data
+    fields = request.GET.get("fields")
+    if fields:
+        data = project_fields(data, fields.split(","))
 
-    if created:
-        weather_data_object.update_data(
-            get_weather_data_from_api(latitude=latitude, longitude=longitude)
-        )
-        data = weather_data_object.weather_data
-        if "error" in data:
-            return JsonResponse(
-                {"message": f"Error fetching weather data: {data['error']}"}, status=500
-            )
-        return JsonResponse(data, status=200)
+    response = JsonResponse(data, status=200)
+    age = (timezone.now() - entry["updated_at"]).total_seconds()
+    patch_cache_control(
+        response, private=True, max_age=max(0, int(settings.WEATHER_CACHE_FRESH_FOR - age))
+    )
+    return response
+
+
+def metrics_view(request):
+    return HttpResponse(metrics.render(), content_type=CONTENT_TYPE_LATEST)
 
-    # The reason for the next restriction is payments for weather data service
-    if timezone.now() - weather_data_object.updated_at > timedelta(hours=1):
-        weather_data_object.update_data(
-            get_weather_data_from_api(latitude=latitude, longitude=longitude)
-        )
 
-    return JsonResponse(data, status=200)
+def city_status_view(request, city_id):
+    city = get_object_or_404(City, id=city_id)
+    if not city.is_pending and request.user.is_authenticated:
+        # The poller reloads next; make sure that render doesn't reuse the
+        # fragment still showing "Locating..."
+        invalidate_main_page(request.user.pk)
+    return JsonResponse(
+        {"status": city.status, "latitude": city.latitude, "longitude": city.longitude},
+        status=200,
+    )
@@ -0,0 +1,98 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+def _key(city_id):
+    return f"weather:{city_id}"
+
+
+def _lock_key(city_id):
+    return f"weather:{city_id}:lock"
+
+
+def store_weather(weather):
+    if not weather.weather_data or "error" in weather.weather_data:
+        return
+    entry = {"data": weather.weather_data, "updated_at": weather.updated_at}
+    cache.set(_key(weather.city_id), entry, settings.WEATHER_CACHE_TIMEOUT)
+    return entry
+
+
+def is_stale(entry):
+    return timezone.now() - entry["updated_at"] > timedelta(seconds=settings.WEATHER_CACHE_FRESH_FOR)
+
+
+def acquire_refresh_lock(city_id):
+    # cache.add only succeeds for the first caller, which makes it the single
+    # flight for this city until the lock is released or expires
+    return cache.add(_lock_key(city_id), True, settings.WEATHER_REFRESH_LOCK_TIMEOUT)
+
+
+def release_refresh_lock(city_id):
+    cache.delete(_lock_key(city_id))
+
+
+def schedule_refresh(city):
+    from .tasks import refresh_city_weather
+
+    if acquire_refresh_lock(city.id):
+        logger.info("Updating weather data for city %s in background", city.name)
+        transaction.on_commit(lambda: refresh_city_weather.delay(city.id))
+
+
+def refresh(city, rate_wait=None):
+    from .providers import get_provider
+
+    try:
+        data = get_provider().fetch(city.latitude, city.longitude, rate_wait)
+        if "error" in data:
+            logger.warning("Weather data for city %s hasn't been updated. Error: %s", city.name, data["error"])
+            return {"data": data, "updated_at": timezone.now()}
+
+        weather = city.current_weather
+        if weather is None:
+            weather = city.data.create(weather_data=data)
+        else:
+            weather.update_data(data)
+        return {"data": weather.weather_data, "updated_at": weather.updated_at}
+    finally:
+        release_refresh_lock(city.id)
+
+
+def _fetch_single_flight(city):
+    if acquire_refresh_lock(city.id):
+        # On the request path: fail fast rather than wait for a rate limit token
+        return refresh(city, rate_wait=0)
+
+    deadline = time.monotonic() + settings.WEATHER_SINGLE_FLIGHT_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(_key(city.id))
+        if entry is not None:
+            return entry
+    return None
+
+
+def get_city_weather(city):
+    entry = cache.get(_key(city.id))
+    CACHE_REQUESTS.labels("weather", "miss" if entry is None else "hit").inc()
+    if entry is None:
+        weather = city.current_weather
+        if weather is not None:
+            entry = store_weather(weather)
+
+    if entry is None:
+        return _fetch_single_flight(city)
+    if is_stale(entry):
+        schedule_refresh(city)
+    return entry